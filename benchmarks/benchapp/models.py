@@ -0,0 +1,21 @@
+from django.db import models
+
+from moderation.models import ModeratedModel
+
+
+class Author(ModeratedModel):
+    name = models.CharField(max_length=100)
+    slug = models.SlugField()
+
+    def __unicode__(self):
+        return self.name
+
+
+class Article(ModeratedModel):
+    author = models.ForeignKey(Author)
+    title = models.CharField(max_length=200)
+    slug = models.SlugField()
+    body = models.TextField()
+
+    def __unicode__(self):
+        return self.title
@@ -0,0 +1,94 @@
+"""
+Compares moderation.diff.get_diff_operations with the previous difflib based
+implementation on synthetic texts. Prints one JSON object per case.
+
+    python benchmarks/diff_benchmark.py [--sizes 1000,10000,50000] [--edits 50]
+"""
+import difflib
+import optparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+
+from django.utils import simplejson
+
+from moderation.diff import get_diff_operations
+
+VOCABULARY = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit',
+              'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore')
+
+
+def legacy_diff_operations(a, b):
+    operations = []
+    a_words = re.split('(\W+)', a)
+    b_words = re.split('(\W+)', b)
+    sequence_matcher = difflib.SequenceMatcher(None, a_words, b_words)
+    for operation, start_a, end_a, start_b, end_b in sequence_matcher.get_opcodes():
+        operations.append({'operation': operation,
+                           'deleted': ''.join(a_words[start_a:end_a]),
+                           'inserted': ''.join(b_words[start_b:end_b])})
+    return operations
+
+
+def make_text(words, rnd):
+    paragraphs = []
+    while words > 0:
+        size = min(words, rnd.randint(40, 120))
+        paragraphs.append(' '.join(rnd.choice(VOCABULARY) for i in xrange(size)) + '.')
+        words -= size
+    return '\n\n'.join(paragraphs)
+
+
+def edit_text(text, edits, rnd):
+    words = text.split(' ')
+    for i in xrange(edits):
+        position = rnd.randrange(len(words))
+        action = rnd.choice(('replace', 'insert', 'delete'))
+        if action == 'replace':
+            words[position] = rnd.choice(VOCABULARY).upper()
+        elif action == 'insert':
+            words.insert(position, rnd.choice(VOCABULARY).upper())
+        elif len(words) > 1:
+            del words[position]
+    return ' '.join(words)
+
+
+def measure(func, a, b, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        operations = func(a, b)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(operations)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='1000,10000,50000', help='comma separated word counts')
+    parser.add_option('--edits', type='int', default=50, help='number of random word edits')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=42)
+    options, args = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    for size in map(int, options.sizes.split(',')):
+        a = make_text(size, rnd)
+        b = edit_text(a, options.edits, rnd)
+        for name, func in (('legacy', legacy_diff_operations), ('current', get_diff_operations)):
+            elapsed, operations = measure(func, a, b, options.repeat)
+            sys.stdout.write(simplejson.dumps({'benchmark': 'get_diff_operations', 'implementation': name,
+                'words': size, 'edits': options.edits, 'seconds': round(elapsed, 6), 'operations': operations}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Times the moderation hot paths against a synthetic project and counts the queries
+they run. Prints one JSON object per benchmark.
+
+    python benchmarks/moderation_benchmark.py [--authors 50] [--articles 10] [--pending 2] [--words 500]
+
+Runs against an in-memory SQLite database by default. Set BENCH_DB_ENGINE, BENCH_DB_NAME,
+BENCH_DB_USER, BENCH_DB_PASSWORD, BENCH_DB_HOST and BENCH_DB_PORT to use another
+database; a throwaway test database is created next to it and dropped afterwards.
+"""
+import optparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bench_settings')
+
+import django
+from django.conf import settings
+
+# load the bench settings before diff_benchmark checks whether settings are configured
+settings.INSTALLED_APPS
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries
+from django.test.client import Client
+from django.utils import simplejson
+
+from benchapp.models import Author, Article
+from diff_benchmark import make_text, edit_text
+from moderation.bulk import chunks
+from moderation.cache import get_diff_cache
+from moderation.diff import get_diff_operations
+from moderation.forms import put_on_moderation, bulk_put_on_moderation
+from moderation.models import Changeset, MODERATION_PENDING_LIST
+
+CHANGELIST_URL = '/admin/moderation/changeset/'
+
+
+def populate(options, rnd, user):
+    Author.all_objects.bulk_create([
+        Author(name='Author %d' % i, slug='author-%d' % i, moderation_active=True)
+        for i in xrange(options.authors)
+    ])
+    authors = list(Author.all_objects.order_by('pk'))
+
+    Article.all_objects.bulk_create([
+        Article(author=author, title='Article %d-%d' % (author.pk, i), slug='article-%d-%d' % (author.pk, i),
+                body=make_text(options.words, rnd), moderation_active=True)
+        for author in authors for i in xrange(options.articles)
+    ])
+    articles = list(Article.all_objects.order_by('pk'))
+
+    items = []
+    for revision in xrange(options.pending):
+        items.extend((author, {'name': '%s v%d' % (author.name, revision)}, False) for author in authors)
+        items.extend((article, {'title': '%s v%d' % (article.title, revision),
+                                'body': edit_text(article.body, options.edits, rnd)}, False)
+                     for article in articles)
+    for batch in chunks(items, 500):
+        bulk_put_on_moderation(batch, user)
+    return authors, articles
+
+
+def measure(func, repeat, setup=None):
+    """
+    Best wall time of repeat runs, and the number of queries of the last run.
+    The diff cache is emptied before every run so renders are always measured cold.
+    """
+    best = None
+    queries = 0
+    for i in xrange(repeat):
+        arg = setup and setup(i)
+        get_diff_cache().clear()
+        reset_queries()
+        start = time.time()
+        func(arg)
+        elapsed = time.time() - start
+        queries = len(connection.queries)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, queries
+
+
+def get_page(client, url, **data):
+    response = client.get(url, data)
+    if response.status_code != 200:
+        raise RuntimeError('GET %s returned %d' % (url, response.status_code))
+    return response
+
+
+def post_action(client, action, ids):
+    response = client.post(CHANGELIST_URL, {'action': action, 'index': 0, '_selected_action': ids})
+    if response.status_code != 302:
+        raise RuntimeError('%s returned %d' % (action, response.status_code))
+    return response
+
+
+def run_benchmarks(options, rnd, user, authors, articles):
+    client = Client()
+    client.login(username=user.username, password='bench')
+
+    author_ct = ContentType.objects.get_for_model(Author)
+    article_ct = ContentType.objects.get_for_model(Article)
+    parent = Changeset.objects.filter(content_type=author_ct, moderation_status__in=MODERATION_PENDING_LIST).order_by('id')[0]
+    article = articles[0]
+
+    pending_articles = Changeset.objects.filter(content_type=article_ct, moderation_status__in=MODERATION_PENDING_LIST)
+    approve_batches = list(chunks(list(pending_articles.order_by('-id').values_list('id', flat=True)), options.approve_batch))
+
+    large_text = make_text(options.diff_words, rnd)
+    edited_text = edit_text(large_text, options.diff_edits, rnd)
+
+    yield 'put_on_moderation', measure(
+        lambda i: put_on_moderation(article, {'title': 'Edited %d' % i}, user, False),
+        options.repeat, setup=lambda i: i)
+    yield 'get_children', measure(lambda arg: parent.get_children(), options.repeat)
+    yield 'changelist_view', measure(lambda arg: get_page(client, CHANGELIST_URL), options.repeat)
+    yield 'change_view', measure(lambda arg: get_page(client, '%s%d/' % (CHANGELIST_URL, parent.pk)), options.repeat)
+    yield 'approve_objects', measure(
+        lambda ids: post_action(client, 'approve_objects', ids),
+        min(options.repeat, len(approve_batches)), setup=lambda i: approve_batches[i])
+    yield 'get_diff_operations', measure(lambda arg: get_diff_operations(large_text, edited_text), options.repeat)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--authors', type='int', default=50, help='number of parent objects')
+    parser.add_option('--articles', type='int', default=10, help='number of child objects (FK to a parent) per parent')
+    parser.add_option('--pending', type='int', default=2, help='pending changesets per object')
+    parser.add_option('--words', type='int', default=500, help='words in every article body')
+    parser.add_option('--edits', type='int', default=5, help='word edits in every pending body change')
+    parser.add_option('--approve-batch', type='int', default=100, help='changesets approved per admin action')
+    parser.add_option('--diff-words', type='int', default=50000, help='words in the large get_diff_operations text')
+    parser.add_option('--diff-edits', type='int', default=200, help='word edits in the large get_diff_operations text')
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--seed', type='int', default=42)
+    options, args = parser.parse_args()
+
+    rnd = random.Random(options.seed)
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        user = User.objects.create_superuser('bench', 'bench@example.com', 'bench')
+        start = time.time()
+        authors, articles = populate(options, rnd, user)
+        populate_seconds = time.time() - start
+
+        params = dict((name, getattr(options, name)) for name in
+                      ('authors', 'articles', 'pending', 'words', 'edits', 'approve_batch', 'diff_words', 'diff_edits', 'repeat', 'seed'))
+        params.update(database=connection.vendor, django=django.get_version(), changesets=Changeset.objects.count(),
+                      populate_seconds=round(populate_seconds, 3))
+
+        for name, (elapsed, queries) in run_benchmarks(options, rnd, user, authors, articles):
+            sys.stdout.write(simplejson.dumps(dict(params, benchmark=name, seconds=round(elapsed, 6),
+                queries=queries), sort_keys=True) + '\n')
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
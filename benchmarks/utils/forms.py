@@ -0,0 +1,7 @@
+"""
+Stand-in for the host project's utils.forms, which moderation.forms builds its formsets on.
+"""
+
+
+class ChangeLoggingFormset(object):
+    pass
@@ -1,57 +1,160 @@
 from django.conf import settings
 from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, PAGE_VAR, IS_POPUP_VAR, TO_FIELD_VAR
+from django.core.paginator import Paginator, InvalidPage
 from django.forms.models import ModelForm, modelform_factory
 from django.contrib.contenttypes.models import ContentType
+from django.conf.urls import patterns, url
 from django.core import urlresolvers
+from django.core.exceptions import PermissionDenied
 import django
+from django.db import connection, transaction
+from django.db.models import Sum
 from django.shortcuts import redirect
 
-from moderation.models import Changeset, MODERATION_STATUS_PENDING, MODERATION_STATUS_REJECTED, MODERATION_STATUS_APPROVED, MODERATION_PENDING_LIST
+from moderation.models import Changeset, QueueCounter, ApprovalJob, async_approval_enabled, JOB_ACTION_APPROVE, JOB_ACTION_REJECT, prefetch_content_objects, prefetch_related_labels, get_queue_stats, STATUS_COUNTER_FIELDS, MODERATION_STATUS_PENDING, MODERATION_STATUS_REJECTED, MODERATION_STATUS_APPROVED, MODERATION_STATUS_APPLYING, MODERATION_PENDING_LIST
 
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 from moderation.forms import BaseModeratedObjectForm
-from moderation.diff import get_changes_between_models, calculate_full_diff
+from moderation.bulk import bulk_approve, bulk_reject
+from moderation.paginator import KeysetPaginator
+from moderation.squash import squash_pending, squash_queryset
+from moderation.diff import get_changes_between_models
+
+
+def report_bulk_result(modeladmin, request, result, verb):
+    if result.succeeded:
+        modeladmin.message_user(request, _(u'%(count)d moderated objects %(verb)s') % {
+            'count': len(result.succeeded), 'verb': verb})
+    for pk, error in sorted(result.failed.items()):
+        messages.error(request, _(u'Changeset %(pk)s failed: %(error)s') % {'pk': pk, 'error': error})
+
+
+def claim_selected(request, queryset):
+    """
+    The selected changesets the moderator may decide, leased to them; the others are
+    reported and left alone.
+    """
+    pks = list(queryset.exclude(object_pk=None).values_list('pk', flat=True))
+    claimed = Changeset.objects.claim_for_decision(request.user, pks)
+    if len(claimed) < len(pks):
+        messages.warning(request, _(u'%(count)d changes were skipped: already decided, being applied '
+            u'or leased to another moderator') % {'count': len(pks) - len(claimed)})
+    return Changeset.objects.filter(pk__in=claimed)
 
 
 def approve_objects(modeladmin, request, queryset):
-    for obj in queryset:
-        if obj.object_pk and obj.content_object:
-            obj.approve(user=request.user, reason='')
+    result = bulk_approve(claim_selected(request, queryset), user=request.user, reason='')
+    report_bulk_result(modeladmin, request, result, _(u'approved'))
 
 approve_objects.short_description = "Approve selected moderated objects"
 
 
 def reject_objects(modeladmin, request, queryset):
-    for obj in queryset:
-        if obj.object_pk and obj.content_object:
-            obj.reject(user=request.user, reason='')
+    result = bulk_reject(claim_selected(request, queryset), user=request.user, reason='')
+    report_bulk_result(modeladmin, request, result, _(u'rejected'))
 
 reject_objects.short_description = "Reject selected moderated objects"
 
 
+def approve_squashed_objects(modeladmin, request, queryset):
+    approved = []
+    for changesets in squash_queryset(queryset):
+        pks = [cs.pk for cs in changesets.changesets]
+        if len(Changeset.objects.claim_for_decision(request.user, pks)) < len(pks):
+            messages.warning(request, _(u'Changes of %(object)s were skipped: some are leased to another moderator')
+                % {'object': changesets.effective.content_object})
+        elif changesets.approve(request.user, ''):
+            approved.append(changesets)
+    modeladmin.message_user(request, _(u'%(count)d objects approved with their pending changes combined') % {
+        'count': len(approved)})
+
+approve_squashed_objects.short_description = "Approve all pending changes of selected objects at once"
+
+
+@transaction.commit_on_success
 def set_objects_as_pending(modeladmin, request, queryset):
+    QueueCounter.objects.record_queryset(queryset, MODERATION_STATUS_PENDING)
     queryset.update(moderation_status=MODERATION_STATUS_PENDING)
 
 set_objects_as_pending.short_description = "Set selected moderated objects "\
                                            "as Pending"
 
 
+OBJECT_STATE_CREATED = 0
+OBJECT_STATE_PENDING = 1
+OBJECT_STATE_APPROVED = 2
+
+OBJECT_STATE_CHOICES = (
+    (OBJECT_STATE_CREATED, ugettext_lazy('Created')),
+    (OBJECT_STATE_PENDING, ugettext_lazy('Pending')),
+    (OBJECT_STATE_APPROVED, ugettext_lazy('Aproved')),
+)
+
+
+def moderation_state_sql(model):
+    """
+    SQL expression computing the OBJECT_STATE_* of every row of a moderated model,
+    with the pending check done by a correlated EXISTS on the changeset table.
+    """
+    qn = connection.ops.quote_name
+    changeset_table = qn(Changeset._meta.db_table)
+    sql = 'CASE WHEN NOT %(table)s.%(active)s THEN %(created)d ' \
+          'WHEN EXISTS (SELECT 1 FROM %(changeset)s WHERE %(changeset)s.content_type_id = %%s ' \
+          'AND %(changeset)s.object_pk = %(table)s.%(pk)s ' \
+          'AND %(changeset)s.moderation_status IN (%(statuses)s)) THEN %(pending)d ' \
+          'ELSE %(approved)d END' % {
+        'table': qn(model._meta.db_table),
+        'active': qn(model._meta.get_field('moderation_active').column),
+        'pk': qn(model._meta.pk.column),
+        'changeset': changeset_table,
+        'statuses': ', '.join(map(str, MODERATION_PENDING_LIST)),
+        'created': OBJECT_STATE_CREATED,
+        'pending': OBJECT_STATE_PENDING,
+        'approved': OBJECT_STATE_APPROVED,
+    }
+    return sql, [ContentType.objects.get_for_model(model).pk]
+
+
+class ModerationStateListFilter(admin.SimpleListFilter):
+    title = ugettext_lazy('Moderation')
+    parameter_name = 'moderation_state'
+
+    def lookups(self, request, model_admin):
+        return OBJECT_STATE_CHOICES
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        sql, params = moderation_state_sql(queryset.model)
+        return queryset.extra(where=['(%s) = %%s' % sql], params=params + [int(self.value())])
+
+
 class ModerationAdmin(admin.ModelAdmin):
+    def __init__(self, *args, **kwargs):
+        super(ModerationAdmin, self).__init__(*args, **kwargs)
+        self.list_filter = list(self.list_filter) + [ModerationStateListFilter]
+
     def get_list_display(self, request):
         return list(self.list_display) + ['get_moderation_status']
 
     def get_moderation_status(self, obj):
-        if obj.moderation_active:
-            if obj.changeset_set.filter(moderation_status__in=MODERATION_PENDING_LIST).exists():
-                return _('Pending')
+        state = getattr(obj, 'moderation_state', None)
+        if state is None:
+            if not obj.moderation_active:
+                state = OBJECT_STATE_CREATED
+            elif obj.changeset_set.filter(moderation_status__in=MODERATION_PENDING_LIST).exists():
+                state = OBJECT_STATE_PENDING
             else:
-                return _('Aproved')
-        else:
-            return _('Created')
+                state = OBJECT_STATE_APPROVED
+        return dict(OBJECT_STATE_CHOICES)[state]
     get_moderation_status.short_description = _('Moderation')
+    get_moderation_status.admin_order_field = 'moderation_state'
 
     def queryset(self, request):
-        return self.model.all_objects.all()
+        sql, params = moderation_state_sql(self.model)
+        return self.model.all_objects.all().extra(select={'moderation_state': sql}, select_params=params)
 
     def get_form(self, request, obj=None):
         if self.form:
@@ -88,6 +191,79 @@ class ModerationAdmin(admin.ModelAdmin):
 
 available_filters = ('content_type', 'moderation_status')
 
+
+KEYSET_VAR = 'after'
+
+IGNORED_COUNT_PARAMS = (ALL_VAR, ORDER_VAR, ORDER_TYPE_VAR, PAGE_VAR, IS_POPUP_VAR, TO_FIELD_VAR)
+COUNTER_FILTER_PARAMS = ('moderation_status__in', 'moderation_status__exact', 'content_type__id__exact')
+
+
+class ModeratedChangeList(ChangeList):
+    def estimate_count(self, params):
+        """
+        Number of changesets matching params taken from the queue counters, or None
+        when the filters cannot be answered from them.
+        """
+        if self.query or [k for k in params if k not in COUNTER_FILTER_PARAMS]:
+            return None
+
+        statuses = STATUS_COUNTER_FIELDS.keys()
+        try:
+            if 'moderation_status__in' in params:
+                statuses = [int(st) for st in params['moderation_status__in'].split(',') if st]
+            elif 'moderation_status__exact' in params:
+                statuses = [int(params['moderation_status__exact'])]
+        except ValueError:
+            return None
+
+        counters = QueueCounter.objects.all()
+        if 'content_type__id__exact' in params:
+            counters = counters.filter(content_type=params['content_type__id__exact'])
+        totals = counters.aggregate(**dict((STATUS_COUNTER_FIELDS[st], Sum(STATUS_COUNTER_FIELDS[st]))
+                                           for st in statuses if st in STATUS_COUNTER_FIELDS))
+        return sum(v or 0 for v in totals.values())
+
+    def get_results(self, request):
+        lookup_params = dict((k, v) for k, v in self.params.items() if k not in IGNORED_COUNT_PARAMS)
+        result_count = self.estimate_count(lookup_params)
+        if result_count is None:
+            result_count = self.query_set.count()
+        full_result_count = self.estimate_count({})
+
+        paginator = KeysetPaginator(self.query_set, self.list_per_page, count=result_count)
+        keyset = list(self.query_set.query.order_by) in (['id'], ['pk'])
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        # the counts may be estimates, they only drive the display; every branch is sliced
+        after = getattr(request, 'moderation_keyset_after', None)
+        if self.show_all and can_show_all:
+            result_list = list(self.query_set[:self.list_max_show_all])
+        elif after is not None and keyset:
+            result_list = paginator.page_after(after).object_list
+        elif keyset:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        else:
+            try:
+                result_list = Paginator(self.query_set, self.list_per_page).page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = prefetch_content_objects(result_list)
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+        self.next_page_query = None
+        if keyset and len(self.result_list) == self.list_per_page:
+            self.next_page_query = self.get_query_string({KEYSET_VAR: self.result_list[-1].pk}, [PAGE_VAR])
+
+
 class ModeratedObjectAdmin(admin.ModelAdmin):
     date_hierarchy = 'date_created'
     list_display = ('content_object', 'content_type', 'date_created', 'moderation_status', 'moderated_by', 'moderation_date')
@@ -95,11 +271,30 @@ class ModeratedObjectAdmin(admin.ModelAdmin):
     ordering = ['id']
     change_form_template = 'moderation/moderate_object.html'
     change_list_template = 'moderation/moderated_objects_list.html'
-    actions = [reject_objects, approve_objects, set_objects_as_pending]
+    actions = [reject_objects, approve_objects, approve_squashed_objects, set_objects_as_pending]
     fieldsets = (
         ('Object moderation', {'fields': ('moderation_reason',)}),
     )
 
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.module_name
+        return patterns('',
+            url(r'^next/$', self.admin_site.admin_view(self.next_view), name='%s_%s_next' % info),
+        ) + super(ModeratedObjectAdmin, self).get_urls()
+
+    def next_view(self, request):
+        """
+        Leases a batch of pending changesets to the moderator and opens the oldest one.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        changesets = Changeset.objects.checkout(request.user)
+        if not changesets:
+            messages.info(request, _(u'There are no pending changes left to moderate'))
+            return redirect('..')
+        return redirect('../%d/' % changesets[0].pk)
+
     def get_actions(self, request):
         actions = super(ModeratedObjectAdmin, self).get_actions(request)
         # Remove the delete_selected action if it exists
@@ -109,6 +304,9 @@ class ModeratedObjectAdmin(admin.ModelAdmin):
             pass
         return actions
 
+    def get_changelist(self, request, **kwargs):
+        return ModeratedChangeList
+
     def get_moderated_object_form(self, model_class):
 
         class ModeratedObjectForm(ModelForm):
@@ -119,9 +317,17 @@ class ModeratedObjectAdmin(admin.ModelAdmin):
         return ModeratedObjectForm
 
     def changelist_view(self, request, extra_context=None):
+        if KEYSET_VAR in request.GET:
+            request.GET = request.GET.copy()
+            try:
+                request.moderation_keyset_after = int(request.GET.pop(KEYSET_VAR)[0])
+            except ValueError:
+                pass
+
         if not request.GET:
             request.GET = request.GET.copy()
             request.GET.update({'moderation_status__in': ','.join(map(str, MODERATION_PENDING_LIST))})
+        extra_context = dict(extra_context or {}, queue_stats=get_queue_stats())
         return super(ModeratedObjectAdmin, self).changelist_view(request, extra_context)
 
     def change_view(self, request, object_id, extra_context=None):
@@ -138,29 +344,49 @@ class ModeratedObjectAdmin(admin.ModelAdmin):
             return redirect('..')
 
         children = changeset.get_children()
+        squashed = squash_pending(changeset.content_type_id, changeset.object_pk)
 
         if request.POST:
             admin_form = self.get_form(request, changeset)(request.POST)
 
             if admin_form.is_valid():
                 reason = admin_form.cleaned_data['moderation_reason']
-                if 'approve' in request.POST:
-                    changeset.approve(request.user, reason)
+                claim = 'approve_all' in request.POST and squashed and [cs.pk for cs in squashed.changesets] or [changeset.pk]
+                if changeset.is_applying:
+                    messages.error(request, _(u'This change is already being applied'))
+                elif len(Changeset.objects.claim_for_decision(request.user, claim)) < len(claim):
+                    holder = Changeset.objects.get(pk=changeset.pk).get_lease_holder()
+                    if holder is not None and holder != request.user:
+                        messages.error(request, _(u'This change is leased to %(user)s') % {'user': holder})
+                    else:
+                        messages.error(request, _(u'This change has already been decided'))
+                elif 'approve_all' in request.POST and squashed:
+                    squashed.approve(request.user, reason)
                     for c in children:
                         c.approve(request.user, reason)
                         [c1.approve(request.user, reason) for c1 in c.get_children()]
+                    changeset = Changeset.objects.get(pk=changeset.pk)
+                elif async_approval_enabled() and ('approve' in request.POST or 'reject' in request.POST):
+                    action = 'approve' in request.POST and JOB_ACTION_APPROVE or JOB_ACTION_REJECT
+                    ApprovalJob.objects.enqueue(changeset, action, request.user, reason)
+                    messages.success(request, _(u'The decision is queued and will be applied shortly'))
+                elif 'approve' in request.POST:
+                    changeset.approve_with_children(request.user, reason)
                 elif 'reject' in request.POST:
-                    changeset.reject(request.user, reason)
-                    for c in children:
-                        c.reject(request.user, reason)
-                        [c1.reject(request.user, reason) for c1 in c.get_children()]
+                    changeset.reject_with_children(request.user, reason)
+
+            squashed = squash_pending(changeset.content_type_id, changeset.object_pk)
 
-        full_diff = calculate_full_diff(changeset.content_object, changeset.object_diff)
+        prefetch_related_labels([changeset] + children + (squashed and [squashed.effective] or []))
+        full_diff = changeset.get_rendered_diff()
 
         extra_context = {
             'changeset': changeset,
             'changes': full_diff,
             'children': children,
+            'squashed': squashed and len(squashed) > 1 and squashed or None,
+            'history': changeset.get_history(),
+            'lease_holder': changeset.get_lease_holder(),
             'django_version': django.get_version()[:3],
         }
         return super(ModeratedObjectAdmin, self).change_view(request,
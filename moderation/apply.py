@@ -0,0 +1,198 @@
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+from django.utils.importlib import import_module
+
+from moderation.uploads import is_staged, promote_file
+
+
+SLUG_SUFFIX_DIGITS = 3
+
+
+def resolve_slug(model, slug, object_pk, reserved=None):
+    """
+    Returns slug, or slug with the first free "_N" suffix, fitting the field's max_length.
+    Every taken slug among the candidates is fetched in one query. Slugs handed out earlier
+    in the same batch but not saved yet can be passed in reserved, a {slug: object pk}
+    dict; the caller adds to it once the object's row is committed.
+
+    Concurrent transactions do not see each other's slugs and may pick the same one;
+    give the slug field unique=True to have the database refuse the second of them.
+    """
+    max_length = model._meta.get_field('slug').max_length or 50
+    reserved = reserved or {}
+    slug = slug[:max_length]
+
+    digits = SLUG_SUFFIX_DIGITS
+    while True:
+        if len(slug) <= max_length - digits - 1:
+            # no candidate is truncated, only slug and slug_N can collide
+            similar = Q(slug=slug) | Q(slug__startswith=slug + '_')
+        else:
+            similar = Q(slug__startswith=slug[:max_length - digits - 1])
+        taken = set(model._base_manager.exclude(pk=object_pk).filter(similar).values_list('slug', flat=True))
+        taken.update(s for s, pk in reserved.items() if pk != object_pk)
+
+        candidates = [slug]
+        for n in xrange(2, 10 ** digits):
+            suffix = '_%d' % n
+            candidates.append(slug[:max_length - len(suffix)] + suffix)
+
+        for candidate in candidates:
+            if candidate not in taken:
+                return candidate
+        digits += 1
+
+
+class ApplyContext(object):
+    def __init__(self, changeset, model, obj=None, reserved_slugs=None):
+        self.changeset = changeset
+        self.model = model
+        self._obj = obj
+        self.reserved_slugs = reserved_slugs
+
+    @property
+    def obj(self):
+        if self._obj is None:
+            self._obj = self.changeset.content_object
+        return self._obj
+
+
+def plain_value(field, value, context):
+    return value
+
+
+def foreign_key_value(field, value, context):
+    if isinstance(value, int):
+        return field.rel.to(pk=value)
+    return value
+
+
+def staged_file_value(field, value, context):
+    if is_staged(value):
+        return promote_file(field, context.obj, value)
+    return value
+
+
+def slug_value(field, value, context):
+    if value:
+        return resolve_slug(context.model, value, context.changeset.object_pk, context.reserved_slugs)
+    return value
+
+
+def filebrowse_value(field, value, context):
+    from filebrowser.fields import FileObject
+    return FileObject(u'%s%s' % (settings.FILEBROWSER_DIRECTORY, value))
+
+
+def tag_value(field, value, context):
+    from tagging.models import Tag
+    from tagging.utils import parse_tag_input
+    lower_tags = []
+    real_tags = []
+    for t in parse_tag_input(value):
+        if not t.lower() in lower_tags:
+            lower_tags.append(t.lower())
+            real_tags.append(t)
+    Tag.objects.update_tags(context.obj, ', '.join('"%s"' % t for t in real_tags))
+    return value
+
+
+# handlers registered from code, most recent first, then those of MODERATION_APPLY_HANDLERS
+APPLY_HANDLERS = []
+
+BUILTIN_APPLY_HANDLERS = [
+    (models.FileField, staged_file_value),
+    (models.ForeignKey, foreign_key_value),
+]
+
+OPTIONAL_APPLY_HANDLERS = (
+    ('filebrowser.fields.FileBrowseField', filebrowse_value),
+    ('tagging.fields.TagField', tag_value),
+)
+
+_plans = {}
+
+
+def register_apply_handler(field_class, handler):
+    """
+    Applies approved values of fields of field_class (and its subclasses) with
+    handler(field, value, context), which returns the value to store.
+    """
+    APPLY_HANDLERS.insert(0, (field_class, handler))
+    _plans.clear()
+
+
+def load(path):
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def load_apply_handlers():
+    # resolve every path before registering any, so a bad one leaves nothing half loaded
+    handlers = [(load(field_path), load(handler_path))
+                for field_path, handler_path in getattr(settings, 'MODERATION_APPLY_HANDLERS', {}).items()]
+
+    optional = []
+    for field_path, handler in OPTIONAL_APPLY_HANDLERS:
+        try:
+            optional.append((load(field_path), handler))
+        except (ImportError, AttributeError):
+            pass
+
+    APPLY_HANDLERS.extend(handlers)
+    BUILTIN_APPLY_HANDLERS[:0] = optional
+    _plans.clear()
+
+
+def get_field_handler(field):
+    if field.name == 'slug':
+        return slug_value
+    for field_class, handler in APPLY_HANDLERS + BUILTIN_APPLY_HANDLERS:
+        if isinstance(field, field_class):
+            return handler
+    return plain_value
+
+
+class ApplyPlan(object):
+    """
+    The editable fields of a model with the handler of each and whether it accepts None,
+    and its many-to-many fields that can be assigned directly.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.fields = {}
+        for field, m in model._meta.get_fields_with_model():
+            if field.editable:
+                self.fields[field.name] = (field, get_field_handler(field), field.null and field.blank)
+        self.m2m_fields = set(field.name for field in model._meta.many_to_many
+                              if field.editable and field.rel.through._meta.auto_created)
+
+    def get_update_params(self, changeset, diff, obj=None, reserved_slugs=None):
+        context = ApplyContext(changeset, self.model, obj, reserved_slugs)
+        update_params = {}
+        for k, v in diff.items():
+            try:
+                field, handler, accepts_none = self.fields[k]
+            except KeyError:
+                continue
+            if v is None and not accepts_none:
+                continue
+            update_params[k] = handler(field, v, context)
+        return update_params
+
+    def apply_m2m(self, obj, diff):
+        for k, v in diff.items():
+            if k in self.m2m_fields:
+                setattr(obj, k, [getattr(o, 'pk', o) for o in (v or [])])
+
+
+def get_apply_plan(model):
+    if not getattr(get_apply_plan, 'loaded', False):
+        load_apply_handlers()
+        get_apply_plan.loaded = True
+
+    plan = _plans.get(model)
+    if plan is None:
+        plan = _plans[model] = ApplyPlan(model)
+    return plan
@@ -0,0 +1,135 @@
+import datetime
+
+from django.db import transaction
+
+from moderation import metrics
+from moderation.cache import invalidate_object
+from moderation.models import Changeset, QueueCounter, in_transaction, prefetch_content_objects, MODERATION_STATUS_APPROVED, MODERATION_STATUS_REJECTED
+
+
+class BulkResult(object):
+    def __init__(self):
+        self.succeeded = []
+        self.failed = {}
+
+    def __repr__(self):
+        return u'BulkResult: %d succeeded, %d failed' % (len(self.succeeded), len(self.failed))
+
+
+def group_by_content_type(changesets):
+    groups = {}
+    for cs in prefetch_content_objects(changesets):
+        groups.setdefault(cs.content_type_id, []).append(cs)
+    return groups
+
+
+def mark_decided(changesets, status, user, reason):
+    if not changesets:
+        return 0
+
+    deltas = {}
+    for cs in changesets:
+        ct_deltas = deltas.setdefault(cs.content_type_id, {})
+        ct_deltas[cs.moderation_status] = ct_deltas.get(cs.moderation_status, 0) - 1
+        ct_deltas[status] = ct_deltas.get(status, 0) + 1
+    for content_type_id, ct_deltas in deltas.items():
+        QueueCounter.objects.record(content_type_id, ct_deltas)
+
+    now = datetime.datetime.now()
+    updated = Changeset.objects.filter(pk__in=[cs.pk for cs in changesets]).update(
+        moderation_status=status,
+        moderated_by=user,
+        moderation_date=now,
+        moderation_reason=reason,
+        leased_by=None,
+        lease_expires=None,
+    )
+    for cs in changesets:
+        cs.moderation_status = status
+        cs.moderation_date = now
+        cs.leased_by = cs.lease_expires = None
+    metrics.record_decisions(changesets)
+    return updated
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+@metrics.timed('bulk_approve')
+def bulk_approve(changesets, user, reason='', batch_size=500):
+    """
+    Applies changesets grouped by content type, one transaction per batch of a model.
+    Rows that fail are rolled back to their savepoint and reported in the result.
+    """
+    result = BulkResult()
+    for group in group_by_content_type(changesets).values():
+        for batch in chunks(group, batch_size):
+            _approve_batch(batch, user, reason, result)
+    return result
+
+
+@in_transaction
+def approve_in_transaction(changesets, user, reason=''):
+    """
+    Like bulk_approve, but in the caller's transaction, for callers such as
+    bulk_put_on_moderation whose own writes must commit together with the approval.
+    """
+    result = BulkResult()
+    for group in group_by_content_type(changesets).values():
+        _apply_batch(group, user, reason, result)
+    return result
+
+
+@transaction.commit_on_success
+def _approve_batch(batch, user, reason, result):
+    _apply_batch(batch, user, reason, result)
+
+
+def _apply_batch(batch, user, reason, result):
+    approved = []
+    reserved_slugs = {}
+    for cs in batch:
+        obj = cs.content_object
+        if obj is None:
+            result.failed[cs.pk] = u'Object does not exist'
+            continue
+
+        sid = transaction.savepoint()
+        try:
+            applied = cs.apply_changes(obj, reserved_slugs=reserved_slugs)
+        except Exception as e:
+            transaction.savepoint_rollback(sid)
+            result.failed[cs.pk] = unicode(e)
+        else:
+            transaction.savepoint_commit(sid)
+            if applied.get('slug'):
+                reserved_slugs[applied['slug']] = cs.object_pk
+            approved.append(cs)
+
+    mark_decided(approved, MODERATION_STATUS_APPROVED, user, reason)
+    result.succeeded.extend(cs.pk for cs in approved)
+
+
+@metrics.timed('bulk_reject')
+def bulk_reject(changesets, user, reason='', batch_size=500):
+    result = BulkResult()
+    for group in group_by_content_type(changesets).values():
+        for batch in chunks(group, batch_size):
+            _reject_batch(batch, user, reason, result)
+    return result
+
+
+@transaction.commit_on_success
+def _reject_batch(batch, user, reason, result):
+    rejected = []
+    for cs in batch:
+        if cs.content_object is None:
+            result.failed[cs.pk] = u'Object does not exist'
+            continue
+        rejected.append(cs)
+        invalidate_object(cs.content_type_id, cs.object_pk)
+
+    mark_decided(rejected, MODERATION_STATUS_REJECTED, user, reason)
+    result.succeeded.extend(cs.pk for cs in rejected)
@@ -0,0 +1,65 @@
+import random
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from moderation import metrics
+from moderation.diff import calculate_full_diff
+
+DEFAULT_CACHE_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+_cache = None
+
+
+def get_diff_cache():
+    """
+    Cache for rendered diffs: the MODERATION_DIFF_CACHE alias, the project's shared
+    'default' cache unless configured, so invalidations reach every process. With the
+    setting set to None a private local-memory cache bounded to MODERATION_DIFF_CACHE_SIZE
+    entries is used, fit only for single-process deployments.
+    """
+    global _cache
+    if _cache is None:
+        alias = getattr(settings, 'MODERATION_DIFF_CACHE', 'default')
+        if alias:
+            _cache = get_cache(alias)
+        else:
+            _cache = get_cache(DEFAULT_CACHE_BACKEND, LOCATION='moderation-diffs',
+                OPTIONS={'MAX_ENTRIES': getattr(settings, 'MODERATION_DIFF_CACHE_SIZE', 300)})
+    return _cache
+
+
+def version_key(content_type_id, object_pk):
+    return 'moderation:version:%s:%s' % (content_type_id, object_pk)
+
+
+def new_version():
+    return '%08x' % random.getrandbits(32)
+
+
+def get_object_version(content_type_id, object_pk):
+    cache = get_diff_cache()
+    key = version_key(content_type_id, object_pk)
+    version = cache.get(key)
+    if version is None:
+        version = new_version()
+        cache.set(key, version)
+    return version
+
+
+def invalidate_object(content_type_id, object_pk):
+    get_diff_cache().set(version_key(content_type_id, object_pk), new_version())
+
+
+def render_changeset_diff(changeset, name=None):
+    cache = get_diff_cache()
+    key = 'moderation:diff:%s:%s:%s' % (name or changeset.pk, changeset.moderation_status,
+        get_object_version(changeset.content_type_id, changeset.object_pk))
+    rendered = cache.get(key)
+    if rendered is None:
+        with metrics.timer('calculate_full_diff'):
+            rendered = [{'verbose_name': unicode(change.verbose_name), 'diff': change.diff}
+                        for change in calculate_full_diff(changeset.content_object, changeset.diff,
+                            getattr(changeset, '_related_labels', None))]
+        cache.set(key, rendered)
+    return rendered
@@ -4,8 +4,9 @@ from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
 
 import re
-import difflib
+import time
 
+from django.db import models
 from django.db.models import fields
 from django.utils.html import escape
 
@@ -39,6 +40,22 @@ class TextChange(BaseChange):
                 {'diff_operations': get_diff_operations(*self.change)})
 
 
+class HtmlChange(BaseChange):
+    """
+    Diff of rich-text values: tags are atomic tokens, only text runs are marked up,
+    and the markup of the new value is kept so the result stays well-formed. Tags and
+    attributes outside a whitelist are dropped and text is escaped.
+    """
+
+    @property
+    def diff(self):
+        value1, value2 = self.change
+        if value1 == value2:
+            return u''.join(sanitize_tokens(html_to_list(value2)))
+
+        return get_html_diff(value1, value2)
+
+
 class ImageChange(BaseChange):
 
     @property
@@ -49,27 +66,115 @@ class ImageChange(BaseChange):
                 {'left_image': left_image,
                  'right_image': right_image})
 
-def calculate_full_diff(obj, diff):
+def is_relation(field):
+    return isinstance(field, (models.ForeignKey, models.ManyToManyField))
+
+
+def value_pk(value):
+    return value.pk if isinstance(value, models.Model) else value
+
+
+def value_pks(value):
+    if not value:
+        return []
+    if isinstance(value, (QuerySet, list, tuple, set)):
+        return [value_pk(v) for v in value]
+    return [value_pk(value)]
+
+
+class RelatedLabels(object):
+    """
+    Labels of the objects the FK and M2M values of (object, diff) pairs point to, on both
+    sides of the diff. Loaded on first use with one in_bulk per related model and one
+    query per M2M field for the current values, whatever the number of pairs.
+    """
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.current_m2m = None
+        self.labels = None
+
+    def load(self):
+        pks = {}
+        m2m_owners = {}
+        for obj, diff in self.pairs:
+            for k, v in diff.items():
+                try:
+                    field = obj._meta.get_field(k)
+                except FieldDoesNotExist:
+                    continue
+                if not is_relation(field):
+                    continue
+                model_pks = pks.setdefault(field.rel.to, set())
+                model_pks.update(value_pks(v))
+                if isinstance(field, models.ManyToManyField):
+                    m2m_owners.setdefault(field, set()).add(obj.pk)
+                else:
+                    model_pks.add(getattr(obj, field.attname))
+
+        self.current_m2m = {}
+        for field, owner_pks in m2m_owners.items():
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            rows = field.rel.through._default_manager.filter(**{'%s__in' % source: owner_pks}).values_list(source, target)
+            for owner_pk, target_pk in rows:
+                self.current_m2m.setdefault((field, owner_pk), []).append(target_pk)
+                pks[field.rel.to].add(target_pk)
+
+        self.labels = {}
+        for model, model_pks in pks.items():
+            model_pks.discard(None)
+            objects = model._base_manager.in_bulk(list(model_pks))
+            self.labels[model] = dict((pk, unicode(o)) for pk, o in objects.items())
+        self.pairs = None
+
+    def label(self, field, pk):
+        if pk is None:
+            return u''
+        if self.labels is None:
+            self.load()
+        return self.labels.get(field.rel.to, {}).get(pk, unicode(pk))
+
+    def join(self, field, pks):
+        return u', '.join(self.label(field, pk) for pk in pks)
+
+    def current(self, obj, field):
+        if isinstance(field, models.ManyToManyField):
+            if self.labels is None:
+                self.load()
+            return self.join(field, sorted(self.current_m2m.get((field, obj.pk), [])))
+        return self.label(field, getattr(obj, field.attname))
+
+
+def calculate_full_diff(obj, diff, related=None):
+    if related is None:
+        related = RelatedLabels([(obj, diff)])
+
     obj_value = u''
     for k,v in diff.items():
         try:
             field = obj._meta.get_field(k)
         except FieldDoesNotExist:
             continue
+        relation = is_relation(field)
         if obj.moderation_active:
-            try:
-                obj_value = unicode(getattr(obj, k))
-            except ObjectDoesNotExist:
-                obj_value = u''
-
-        if isinstance(v, QuerySet):
+            if relation:
+                obj_value = related.current(obj, field)
+            else:
+                try:
+                    obj_value = unicode(getattr(obj, k))
+                except ObjectDoesNotExist:
+                    obj_value = u''
+
+        if relation:
+            diff_value = related.join(field, value_pks(v))
+        elif isinstance(v, QuerySet):
             diff_value = u', '.join(map(unicode, v))
         else:
             diff_value = unicode(v)
 
         if not obj_value and not v:
             continue
-        yield TextChange(field.verbose_name or k,
+        change_class = get_registered_change_class(field) or TextChange
+        yield change_class(field.verbose_name or k,
             field,
             (unicode(obj_value), diff_value),
         )
@@ -107,33 +212,361 @@ def get_changes_between_models(model1, model2, excludes=[]):
     return changes
 
 
-def get_diff_operations(a, b):
-    operations = []
-    a_words = re.split('(\W+)', a)
-    b_words = re.split('(\W+)', b)
-    sequence_matcher = difflib.SequenceMatcher(None, a_words, b_words)
-    for opcode in sequence_matcher.get_opcodes():
-        operation, start_a, end_a, start_b, end_b = opcode
+DIFF_MAX_TOKENS = 20000
+DIFF_TIMEOUT = 0.5
+
+
+class DiffBudgetExceeded(Exception):
+    pass
+
+
+def split_words(text):
+    return re.split('(\W+)', text)
+
+
+def split_lines(text):
+    return text.splitlines(True)
+
+
+def split_paragraphs(text):
+    return re.split('(\n\s*\n)', text)
+
+
+def _middle_snake(a, alo, ahi, b, blo, bhi, deadline, max_edits):
+    """
+    Myers' linear-space middle snake of a[alo:ahi] and b[blo:bhi]: runs the forward and
+    the backward search until they overlap. Returns the edit distance and the snake as
+    (x, y, u, v) offsets into the slices; only O(D) furthest-reaching points are kept.
+    """
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta & 1
+    forward = {1: 0}
+    backward = {1: 0}
+    for d in xrange((n + m + 1) // 2 + 1):
+        if max_edits is not None and 2 * d - 1 > max_edits:
+            raise DiffBudgetExceeded()
+        if d % 16 == 0 and time.time() > deadline:
+            raise DiffBudgetExceeded()
+
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k] >= n:
+                return 2 * d - 1, x0, y0, x, y
+
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return 2 * d, n - x, m - y, n - x0, m - y0
+    raise DiffBudgetExceeded()
+
+
+def _myers_matching_blocks(a, b, deadline, max_edits):
+    """
+    Myers' O(ND) shortest edit script in linear space (divide and conquer on the middle
+    snake). Returns matching blocks (i, j, size) in order, or raises DiffBudgetExceeded
+    when the edit distance or the deadline is exceeded.
+    """
+    blocks = []
+
+    def add(i, j, size):
+        if not size:
+            return
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            i, j, size = blocks[-1][0], blocks[-1][1], blocks[-1][2] + size
+            blocks.pop()
+        blocks.append((i, j, size))
+
+    def compare(alo, ahi, blo, bhi, max_edits):
+        prefix = 0
+        while alo + prefix < ahi and blo + prefix < bhi and a[alo + prefix] == b[blo + prefix]:
+            prefix += 1
+        add(alo, blo, prefix)
+        alo += prefix
+        blo += prefix
+
+        suffix = 0
+        while alo < ahi - suffix and blo < bhi - suffix and a[ahi - suffix - 1] == b[bhi - suffix - 1]:
+            suffix += 1
+
+        if alo < ahi - suffix and blo < bhi - suffix:
+            d, x, y, u, v = _middle_snake(a, alo, ahi - suffix, b, blo, bhi - suffix, deadline, max_edits)
+            if d > 1:
+                compare(alo, alo + x, blo, blo + y, None)
+                add(alo + x, blo + y, u - x)
+                compare(alo + u, ahi - suffix, blo + v, bhi - suffix, None)
+            else:
+                add(alo + x, blo + y, u - x)
+        add(ahi - suffix, bhi - suffix, suffix)
+
+    compare(0, len(a), 0, len(b), max_edits)
+    return blocks
+
+
+def get_opcodes(a, b, deadline, max_edits):
+    """
+    SequenceMatcher-compatible opcodes, computed with a common prefix/suffix fast path
+    around the Myers diff of the remaining middle part.
+    """
+    n, m = len(a), len(b)
+    prefix = 0
+    while prefix < n and prefix < m and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and suffix < m - prefix and a[n - suffix - 1] == b[m - suffix - 1]:
+        suffix += 1
+
+    blocks = []
+    if prefix:
+        blocks.append((0, 0, prefix))
+    middle = _myers_matching_blocks(a[prefix:n - suffix], b[prefix:m - suffix], deadline, max_edits)
+    blocks.extend((i + prefix, j + prefix, size) for i, j, size in middle)
+    if suffix:
+        blocks.append((n - suffix, m - suffix, suffix))
+    blocks.append((n, m, 0))
+
+    opcodes = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            opcodes.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, ai, j, bj))
+        if size:
+            opcodes.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return opcodes
+
+
+def get_diff_operations(a, b, max_tokens=None, timeout=None):
+    """
+    Word-level diff of two texts. When the token or time budget is exceeded, falls back
+    to line-level, then paragraph-level diffs and finally to a single replacement.
+    """
+    from django.conf import settings
+
+    if max_tokens is None:
+        max_tokens = getattr(settings, 'MODERATION_DIFF_MAX_TOKENS', DIFF_MAX_TOKENS)
+    if timeout is None:
+        timeout = getattr(settings, 'MODERATION_DIFF_TIMEOUT', DIFF_TIMEOUT)
+
+    # one budget for the whole call: every level but the last may use half of what is left
+    final_deadline = time.time() + timeout
+    splits = (split_words, split_lines, split_paragraphs)
+    for level, split in enumerate(splits):
+        now = time.time()
+        if now > final_deadline:
+            break
+        deadline = final_deadline if level == len(splits) - 1 else now + (final_deadline - now) / 2
+        a_tokens = split(a)
+        b_tokens = split(b)
+        if len(a_tokens) + len(b_tokens) > max_tokens:
+            continue
+        try:
+            opcodes = get_opcodes(a_tokens, b_tokens, deadline, max_tokens)
+        except DiffBudgetExceeded:
+            continue
+        return [{'operation': operation,
+                 'deleted': ''.join(a_tokens[start_a:end_a]),
+                 'inserted': ''.join(b_tokens[start_b:end_b])}
+                for operation, start_a, end_a, start_b, end_b in opcodes]
+
+    return [{'operation': 'replace', 'deleted': a, 'inserted': b}]
 
-        deleted = ''.join(a_words[start_a:end_a])
-        inserted = ''.join(b_words[start_b:end_b])
 
-        operations.append({'operation': operation,
-                           'deleted': deleted,
-                           'inserted': inserted})
-    return operations
+HTML_TOKEN_RE = re.compile(r'&#?\w+;|</?[a-zA-Z!?][^<>]*>|\w[\w-]*|\s+|[^\w\s<&]|.', re.UNICODE | re.DOTALL)
 
 
 def html_to_list(html):
-    pattern = re.compile(r'&.*?;|(?:<[^<]*?>)|'\
-                         '(?:\w[\w-]*[ ]*)|(?:<[^<]*?>)|'\
-                         '(?:\s*[,\.\?]*)', re.UNICODE)
+    return HTML_TOKEN_RE.findall(html)
+
+
+ALLOWED_TAGS = frozenset((
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'cite', 'code', 'dd', 'del', 'div', 'dl', 'dt',
+    'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'li', 'ol', 'p', 'pre', 'q',
+    's', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th',
+    'thead', 'tr', 'u', 'ul',
+))
+ALLOWED_ATTRIBUTES = frozenset(('alt', 'colspan', 'height', 'href', 'rowspan', 'src', 'title', 'width'))
+URL_ATTRIBUTES = frozenset(('href', 'src'))
+ALLOWED_URL_SCHEMES = frozenset(('http', 'https', 'mailto', 'ftp'))
+
+TAG_RE = re.compile(r'^<\s*(/?)\s*([a-zA-Z][a-zA-Z0-9]*)(.*?)(/?)\s*>$', re.DOTALL)
+ATTRIBUTE_RE = re.compile(r'([a-zA-Z][\w:-]*)\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+)')
+NUMERIC_ENTITY_RE = re.compile(r'&#(x[0-9a-fA-F]+|\d+);?')
+URL_SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):')
+
+
+def is_safe_url(value):
+    def decode(match):
+        code = match.group(1)
+        try:
+            return unichr(int(code[1:], 16) if code[0] in 'xX' else int(code))
+        except (ValueError, OverflowError):
+            return u''
+    decoded = re.sub(r'[\x00-\x20]', u'', NUMERIC_ENTITY_RE.sub(decode, value))
+    scheme = URL_SCHEME_RE.match(decoded)
+    if scheme:
+        return scheme.group(1).lower() in ALLOWED_URL_SCHEMES
+    # a named entity before the path could hide the scheme separator, e.g. &colon;
+    return '&' not in re.split(r'[/?#]', decoded, 1)[0]
+
+
+def sanitize_tag(token):
+    """
+    Rebuilds a tag keeping only whitelisted tags and attributes; returns u'' for
+    other tags. Anything that is not a tag at all, e.g. "< 2 and 3 >", is escaped
+    as the text it is.
+    """
+    match = TAG_RE.match(token)
+    if not match:
+        return escape(token)
+    closing, name, attributes, self_closing = match.groups()
+    name = name.lower()
+    if name not in ALLOWED_TAGS:
+        return u''
+    if closing:
+        return u'</%s>' % name
+
+    kept = []
+    for attribute, value in ATTRIBUTE_RE.findall(attributes):
+        attribute = attribute.lower()
+        if value[:1] in '"\'':
+            value = value[1:-1]
+        if attribute not in ALLOWED_ATTRIBUTES:
+            continue
+        if attribute in URL_ATTRIBUTES and not is_safe_url(value):
+            continue
+        kept.append(u' %s="%s"' % (attribute, value.replace('"', '&quot;').replace('<', '&lt;').replace('>', '&gt;')))
+    return u'<%s%s%s>' % (name, u''.join(kept), self_closing and u' /' or u'')
+
+
+ENTITY_RE = re.compile(r'^&#?\w+;$')
+
+
+def sanitize_tokens(tokens):
+    """
+    Whitelists tags and escapes text, so submitted markup can be shown as is.
+    """
+    result = []
+    for token in tokens:
+        if token.startswith('<') and token.endswith('>'):
+            token = sanitize_tag(token)
+            if token:
+                result.append(token)
+        elif ENTITY_RE.match(token):
+            result.append(token)
+        else:
+            result.append(escape(token))
+    return result
+
+
+def is_tag(token):
+    return token.startswith('<') and token.endswith('>')
+
+
+def mark_text(tokens, tag):
+    """
+    Wraps every run of text tokens in <tag>, leaving markup tokens untouched.
+    """
+    result = []
+    run = []
+    for token in tokens + [None]:
+        if token is None or is_tag(token):
+            text = ''.join(run)
+            if text.strip():
+                result.append(u'<%s class="diff">%s</%s>' % (tag, text, tag))
+            else:
+                result.append(text)
+            run = []
+            if token is not None:
+                result.append(token)
+        else:
+            run.append(token)
+    return u''.join(result)
+
+
+def get_html_diff(a, b, max_tokens=None, timeout=None):
+    from django.conf import settings
+
+    if max_tokens is None:
+        max_tokens = getattr(settings, 'MODERATION_DIFF_MAX_TOKENS', DIFF_MAX_TOKENS)
+    if timeout is None:
+        timeout = getattr(settings, 'MODERATION_DIFF_TIMEOUT', DIFF_TIMEOUT)
+
+    a_tokens = sanitize_tokens(html_to_list(a))
+    b_tokens = sanitize_tokens(html_to_list(b))
+    opcodes = [('replace', 0, len(a_tokens), 0, len(b_tokens))]
+    if len(a_tokens) + len(b_tokens) <= max_tokens:
+        try:
+            opcodes = get_opcodes(a_tokens, b_tokens, time.time() + timeout, max_tokens)
+        except DiffBudgetExceeded:
+            pass
+
+    result = []
+    for operation, start_a, end_a, start_b, end_b in opcodes:
+        if operation == 'equal':
+            result.append(u''.join(b_tokens[start_b:end_b]))
+            continue
+        deleted = [t for t in a_tokens[start_a:end_a] if not is_tag(t)]
+        result.append(mark_text(deleted, 'del'))
+        result.append(mark_text(b_tokens[start_b:end_b], 'ins'))
+    return u''.join(result)
+
+
+CHANGE_TYPES = []
+
+
+def register_change_type(field_class, change_class):
+    """
+    Renders diffs of fields of field_class (and its subclasses) with change_class,
+    e.g. register_change_type(RichTextField, HtmlChange).
+    """
+    CHANGE_TYPES.insert(0, (field_class, change_class))
+
+
+def load_change_types_from_settings():
+    from django.conf import settings
+    from moderation.apply import load
+
+    # like the apply handlers: resolve every path first, and keep code registrations first
+    CHANGE_TYPES.extend([(load(field_path), load(change_path))
+                         for field_path, change_path in getattr(settings, 'MODERATION_CHANGE_TYPES', {}).items()])
+
+
+def get_registered_change_class(field):
+    if not getattr(get_registered_change_class, 'loaded', False):
+        load_change_types_from_settings()
+        get_registered_change_class.loaded = True
 
-    return [''.join(element) for element in filter(None,
-                                                   pattern.findall(html))]
+    for field_class, change_class in CHANGE_TYPES:
+        if isinstance(field, field_class):
+            return change_class
+    return None
 
 
 def get_change_for_type(verbose_name, change, field):
+    change_class = get_registered_change_class(field)
     if isinstance(field, fields.files.ImageField):
         change = ImageChange(
             u"Current %(verbose_name)s / "\
@@ -142,7 +575,7 @@ def get_change_for_type(verbose_name, change, field):
             change)
     else:
         value1, value2 = change
-        change = TextChange(verbose_name,
+        change = (change_class or TextChange)(verbose_name,
                             field,
                 (unicode(value1), unicode(value2)),
                             )
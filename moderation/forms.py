@@ -3,34 +3,117 @@ from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import File, ContentFile
 from django.forms.models import BaseModelFormSet, BaseInlineFormSet
-from django.db import models
-
-from moderation.models import Changeset, MODERATION_STATUS_PENDING, MODERATION_STATUS_CREATED
+from django.db import models, transaction
+from django.db.utils import IntegrityError
+
+from moderation import metrics
+from moderation.bulk import approve_in_transaction
+from moderation.models import Changeset, ChangesetDependency, ChangesetField, QueueCounter, get_object_dependencies, in_transaction, MODERATION_STATUS_PENDING, MODERATION_STATUS_CREATED
+from moderation.storage import field_index_enabled, hash_value
+from moderation.uploads import stage_file
 from utils.forms import ChangeLoggingFormset
 
 class MockObject():
     def save(self, *args, **kwargs):
         pass
 
+def moderation_skipped(user):
+    MODERATION_SKIP = getattr(settings, 'MODERATION_SKIP', False)
+    SUPERUSER_MODERATION_SKIP = getattr(settings, 'SUPERUSER_MODERATION_SKIP', True)
+
+    return MODERATION_SKIP or (user and user.is_superuser and SUPERUSER_MODERATION_SKIP)
+
+@metrics.timed('put_on_moderation')
+@in_transaction
 def put_on_moderation(obj, data, user, create):
+    """
+    Runs in the caller's transaction: a nested commit_on_success would commit the
+    admin's add_view/change_view transaction before save_m2m and log_change.
+    Callers without a managed transaction get one of their own.
+    """
     ct = ContentType.objects.get_for_model(obj)
-    changeset = Changeset.objects.create(
+    changeset = Changeset.objects.create_revision(
         content_type = ct,
         object_pk = obj.pk,
         changed_by=user,
         moderation_status = create and MODERATION_STATUS_CREATED or MODERATION_STATUS_PENDING,
-        object_diff = data,
+        diff = data,
     )
+    changeset.update_dependencies(obj)
+    changeset.update_field_index()
+    QueueCounter.objects.record(ct.pk, {changeset.moderation_status: 1})
 
-    MODERATION_SKIP = getattr(settings, 'MODERATION_SKIP', False)
-    SUPERUSER_MODERATION_SKIP = getattr(settings, 'SUPERUSER_MODERATION_SKIP', True)
-
-    if MODERATION_SKIP or (user and user.is_superuser and SUPERUSER_MODERATION_SKIP):
+    if moderation_skipped(user):
         changeset.approve(user, 'Auto')
         obj.moderation_active = True
 
+@in_transaction
+def bulk_put_on_moderation(items, user):
+    """
+    Puts a list of (obj, data, create) on moderation with one bulk INSERT per content type.
+    Falls back to put_on_moderation one by one if a concurrent writer took a revision number.
+    Runs in the caller's transaction, like put_on_moderation, auto-approval included.
+    """
+    by_type = {}
+    for obj, data, create in items:
+        by_type.setdefault(ContentType.objects.get_for_model(obj), []).append((obj, data, create))
+
+    changesets = []
+    for ct, ct_items in by_type.items():
+        sid = transaction.savepoint()
+        try:
+            changesets.extend(_bulk_create_changesets(ct, ct_items, user))
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            for obj, data, create in ct_items:
+                put_on_moderation(obj, data, user, create)
+        else:
+            transaction.savepoint_commit(sid)
+
+    if changesets and moderation_skipped(user):
+        approve_in_transaction([cs for cs, obj in changesets], user, 'Auto')
+        for cs, obj in changesets:
+            obj.moderation_active = True
+    return [cs for cs, obj in changesets]
+
+def _bulk_create_changesets(ct, items, user):
+    revisions = Changeset.objects.next_revisions(ct, [obj.pk for obj, data, create in items])
+    new_changesets = []
+    for obj, data, create in items:
+        revision = revisions[obj.pk]
+        revisions[obj.pk] += 1
+        new_changesets.append(Changeset(
+            content_type = ct,
+            object_pk = obj.pk,
+            changed_by = user,
+            moderation_status = create and MODERATION_STATUS_CREATED or MODERATION_STATUS_PENDING,
+            revision = revision,
+            creation = revision == 1,
+            diff = data,
+        ))
+    Changeset.objects.bulk_create(new_changesets)
+
+    keys = dict(((cs.object_pk, cs.revision), obj) for cs, (obj, data, create) in zip(new_changesets, items))
+    saved = Changeset.objects.filter(content_type=ct, object_pk__in=[pk for pk, rev in keys],
+        revision__in=[rev for pk, rev in keys])
+    changesets = [(cs, keys[(cs.object_pk, cs.revision)]) for cs in saved if (cs.object_pk, cs.revision) in keys]
+
+    dependencies = []
+    fields = []
+    counts = {}
+    for cs, obj in changesets:
+        dependencies.extend(ChangesetDependency(changeset=cs, content_type_id=dep_ct_id, object_pk=dep_pk)
+                            for dep_ct_id, dep_pk in get_object_dependencies(obj))
+        if field_index_enabled():
+            fields.extend(ChangesetField(changeset=cs, field_name=k, value_hash=hash_value(v)) for k, v in cs.diff.items())
+        counts[cs.moderation_status] = counts.get(cs.moderation_status, 0) + 1
+    ChangesetDependency.objects.bulk_create(dependencies)
+    ChangesetField.objects.bulk_create(fields)
+    QueueCounter.objects.record(ct.pk, counts)
+    return changesets
+
 class BaseModeratedObjectForm(forms.ModelForm):
-    def save(self, request, commit=True, skip_moderation=False, *args, **kwargs):
+    def save(self, request, commit=True, skip_moderation=False, collect=None, *args, **kwargs):
         if skip_moderation:
             obj = super(BaseModeratedObjectForm, self).save(commit=False, *args, **kwargs)
             obj.moderation_active=True
@@ -53,15 +136,16 @@ class BaseModeratedObjectForm(forms.ModelForm):
                     if create:
                         changes[k] = getattr(self.instance, k).name
                     else:
-                        fake_instance = self._meta.model()
-                        getattr(fake_instance, k).save(v.name, v, save=False)
-                        changes[k] = getattr(fake_instance, k).name
+                        changes[k] = stage_file(self._meta.model._meta.get_field(k), v)
                 else:
                     changes[k] = v
 
         if changes or create:
-            user = request and request.user.is_authenticated() and request.user or None
-            put_on_moderation(self.instance, data=changes, user=user, create=create)
+            if collect is not None:
+                collect.append((self.instance, changes, create))
+            else:
+                user = request and request.user.is_authenticated() and request.user or None
+                put_on_moderation(self.instance, data=changes, user=user, create=create)
         return self.instance
 
     def save_m2m(self):
@@ -76,7 +160,7 @@ class BaseModeratedObjectForm(forms.ModelForm):
 
 class ModerationModelFormset(ChangeLoggingFormset, BaseModelFormSet):
     def save_new(self, form, commit=True, **kwargs):
-        obj = form.save(request=self.request, commit=False, **kwargs)
+        obj = form.save(request=self.request, commit=False, collect=self.moderation_queue, **kwargs)
         if commit:
             obj.save()
         if commit and hasattr(form, 'save_m2m'):
@@ -85,17 +169,22 @@ class ModerationModelFormset(ChangeLoggingFormset, BaseModelFormSet):
 
     def save_existing(self, form, instance, commit=True):
         """Saves and returns an existing model instance for the given form."""
-        return form.save(request=self.request, commit=commit)
+        return form.save(request=self.request, commit=commit, collect=self.moderation_queue)
 
     def save(self, request, instance=None, commit=True):
         if instance:
             self.instance = instance
         self.request = request
-        return super(ModerationModelFormset, self).save(commit=commit)
+        self.moderation_queue = []
+        result = super(ModerationModelFormset, self).save(commit=commit)
+
+        user = request and request.user.is_authenticated() and request.user or None
+        bulk_put_on_moderation(self.moderation_queue, user)
+        return result
 
 class ModerationInlineFormset(ModerationModelFormset, BaseInlineFormSet):
     def save_new(self, form, commit=True, **kwargs):
-        obj = form.save(request=self.request, commit=False, **kwargs)
+        obj = form.save(request=self.request, commit=False, collect=self.moderation_queue, **kwargs)
         pk_value = getattr(self.instance, self.fk.rel.field_name)
         setattr(obj, self.fk.get_attname(), getattr(pk_value, 'pk', pk_value))
 
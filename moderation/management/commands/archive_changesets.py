@@ -0,0 +1,70 @@
+from optparse import make_option
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from moderation.models import Changeset, ArchivedChangeset, QueueCounter, ARCHIVED_FIELDS, MODERATION_STATUS_APPROVED, MODERATION_STATUS_REJECTED
+
+
+class Command(BaseCommand):
+    help = "Moves approved and rejected changesets older than a cutoff to the archive table, or purges them"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+            help='Only changesets decided more than this many days ago'),
+        make_option('--purge', action='store_true', dest='purge', default=False,
+            help='Delete the changesets instead of archiving them'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of changesets moved per transaction'),
+        make_option('--sleep', type='float', dest='sleep', default=0.5,
+            help='Seconds to sleep between batches'),
+        make_option('--limit', type='int', dest='limit', default=None,
+            help='Stop after this many changesets'),
+    )
+
+    def handle(self, *args, **options):
+        if options['days'] is None:
+            raise CommandError('--days is required')
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=options['days'])
+        changesets = Changeset.objects.filter(
+            moderation_status__in=(MODERATION_STATUS_APPROVED, MODERATION_STATUS_REJECTED),
+            moderation_date__lt=cutoff,
+        ).order_by('pk')
+
+        total = 0
+        last_pk = 0
+        while options['limit'] is None or total < options['limit']:
+            size = options['batch_size']
+            if options['limit'] is not None:
+                size = min(size, options['limit'] - total)
+            batch = list(changesets.filter(pk__gt=last_pk).values_list('pk', flat=True)[:size])
+            if not batch:
+                break
+            last_pk = batch[-1]
+
+            if options['purge']:
+                self.purge_batch(batch)
+            else:
+                self.archive_batch(batch)
+            total += len(batch)
+            self.stdout.write("%s %d changesets (last id %d)\n" % (options['purge'] and 'Purged' or 'Archived', total, last_pk))
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+    @transaction.commit_on_success
+    def archive_batch(self, batch):
+        rows = Changeset.objects.filter(pk__in=batch).values_list('pk', *ARCHIVED_FIELDS)
+        ArchivedChangeset.objects.bulk_create([
+            ArchivedChangeset(original_id=row[0], **dict(zip(ARCHIVED_FIELDS, row[1:]))) for row in rows
+        ])
+        Changeset.objects.filter(pk__in=batch).delete()
+
+    @transaction.commit_on_success
+    def purge_batch(self, batch):
+        changesets = Changeset.objects.filter(pk__in=batch)
+        QueueCounter.objects.record_queryset(changesets, None)
+        changesets.delete()
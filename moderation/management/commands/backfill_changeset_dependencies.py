@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from moderation.models import Changeset, ChangesetDependency, MODERATION_PENDING_LIST, get_object_dependencies
+
+
+class Command(BaseCommand):
+    help = "Fills the changeset dependency index for existing changesets"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Index decided changesets too, not only the pending ones'),
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of changesets processed per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        changesets = Changeset.objects.exclude(object_pk=None)
+        if not options['all']:
+            changesets = changesets.filter(moderation_status__in=MODERATION_PENDING_LIST)
+
+        last_pk = 0
+        total = 0
+        while True:
+            batch = list(changesets.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            total += self.index_batch(batch)
+
+        self.stdout.write("Indexed %d dependencies\n" % total)
+
+    @transaction.commit_on_success
+    def index_batch(self, batch):
+        by_type = {}
+        for cs in batch:
+            by_type.setdefault(cs.content_type_id, []).append(cs)
+
+        rows = []
+        for ct_id, changesets in by_type.items():
+            model = ContentType.objects.get_for_id(ct_id).model_class()
+            if model is None:
+                continue
+            objects = model._base_manager.in_bulk([cs.object_pk for cs in changesets])
+            for cs in changesets:
+                obj = objects.get(cs.object_pk)
+                if obj is None:
+                    continue
+                for dep_ct_id, dep_pk in get_object_dependencies(obj):
+                    rows.append(ChangesetDependency(changeset=cs, content_type_id=dep_ct_id, object_pk=dep_pk))
+
+        ChangesetDependency.objects.filter(changeset__in=batch).delete()
+        ChangesetDependency.objects.bulk_create(rows)
+        return len(rows)
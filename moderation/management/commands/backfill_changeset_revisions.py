@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from moderation.models import Changeset
+
+
+class Command(BaseCommand):
+    help = "Numbers existing changesets within their object's history and sets the creation flag"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Number of changesets numbered per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        changesets = Changeset.objects.exclude(object_pk=None).order_by('content_type', 'object_pk', 'id')
+
+        last = None
+        revision = 0
+        total = 0
+        while True:
+            batch = changesets
+            if last:
+                ct_id, object_pk, pk = last
+                batch = batch.filter(Q(content_type__gt=ct_id) |
+                                     Q(content_type=ct_id, object_pk__gt=object_pk) |
+                                     Q(content_type=ct_id, object_pk=object_pk, id__gt=pk))
+            rows = list(batch.values_list('content_type', 'object_pk', 'id', 'revision')[:options['batch_size']])
+            if not rows:
+                break
+
+            revision = self.number_batch(rows, last, revision)
+            last = rows[-1][:3]
+            total += len(rows)
+
+        self.stdout.write("Numbered %d changesets\n" % total)
+
+    @transaction.commit_on_success
+    def number_batch(self, rows, last, revision):
+        for ct_id, object_pk, pk, current in rows:
+            if not last or last[:2] != (ct_id, object_pk):
+                revision = 0
+            revision += 1
+            last = (ct_id, object_pk, pk)
+            if current != revision:
+                Changeset.objects.filter(pk=pk).update(revision=revision, creation=revision == 1)
+        return revision
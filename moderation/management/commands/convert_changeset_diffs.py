@@ -0,0 +1,54 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from moderation.models import Changeset, ChangesetField
+from moderation.storage import encode_diff, hash_value
+
+
+class Command(BaseCommand):
+    help = "Converts pickled changeset diffs to JSON storage, chunk by chunk"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='Number of changesets converted per transaction'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+            help='Seconds to sleep between chunks'),
+        make_option('--index-fields', action='store_true', dest='index_fields', default=False,
+            help='Also fill the per-field change table'),
+        make_option('--keep-pickle', action='store_true', dest='keep_pickle', default=False,
+            help='Do not clear the pickled column after conversion'),
+    )
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        total = 0
+        while True:
+            chunk = list(Changeset.objects.filter(pk__gt=last_pk, object_diff_json=None).order_by('pk')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            self.convert_chunk(chunk, options['index_fields'], options['keep_pickle'])
+            total += len(chunk)
+            self.stdout.write("Converted %d changesets (last id %d)\n" % (total, last_pk))
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+    @transaction.commit_on_success
+    def convert_chunk(self, chunk, index_fields, keep_pickle):
+        fields = []
+        for cs in chunk:
+            diff = cs.object_diff or {}
+            update = {'object_diff_json': encode_diff(diff)}
+            if not keep_pickle:
+                update['object_diff'] = None
+            Changeset.objects.filter(pk=cs.pk).update(**update)
+
+            if index_fields:
+                fields.extend(ChangesetField(changeset=cs, field_name=k, value_hash=hash_value(v)) for k, v in diff.items())
+
+        if index_fields:
+            ChangesetField.objects.filter(changeset__in=chunk).delete()
+            ChangesetField.objects.bulk_create(fields)
@@ -0,0 +1,104 @@
+from optparse import make_option
+import datetime
+import sys
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+from moderation.models import Changeset, ArchivedChangeset, STATUS_CHOICES
+from moderation.storage import DiffEncoder
+
+
+def parse_status(value):
+    for status, label in STATUS_CHOICES:
+        if value.lower() in (str(status), label.lower()):
+            return status
+    raise CommandError('Unknown moderation status: %s' % value)
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError('Dates must be given as YYYY-MM-DD, got %s' % value)
+
+
+def get_content_type(label):
+    try:
+        app_label, model = label.lower().split('.')
+        return ContentType.objects.get_by_natural_key(app_label, model)
+    except (ValueError, ContentType.DoesNotExist):
+        raise CommandError('Unknown content type: %s' % label)
+
+
+def serialize_changeset(cs):
+    return {
+        'id': cs.is_archived and cs.original_id or cs.pk,
+        'content_type': cs.content_type.natural_key(),
+        'object_pk': cs.object_pk,
+        'date_created': cs.date_created,
+        'moderation_status': cs.moderation_status,
+        'moderated_by': cs.moderated_by and cs.moderated_by.username,
+        'moderation_date': cs.moderation_date,
+        'moderation_reason': cs.moderation_reason,
+        'changed_by': cs.changed_by and cs.changed_by.username,
+        'revision': cs.revision,
+        'creation': cs.creation,
+        'diff': cs.diff,
+    }
+
+
+class Command(BaseCommand):
+    help = "Streams changesets as JSON lines, one changeset per line"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--content-type', action='append', dest='content_types', default=[],
+            help='Only changesets of this app_label.model (can be repeated)'),
+        make_option('--status', action='append', dest='statuses', default=[],
+            help='Only changesets with this moderation status, by name or number (can be repeated)'),
+        make_option('--since', dest='since', default=None,
+            help='Only changesets created on or after this date (YYYY-MM-DD)'),
+        make_option('--until', dest='until', default=None,
+            help='Only changesets created before this date (YYYY-MM-DD)'),
+        make_option('--archived', action='store_true', dest='archived', default=False,
+            help='Export the archive table instead of the live changesets'),
+        make_option('--output', dest='output', default=None,
+            help='File to write to, standard output by default'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='Number of changesets fetched per query'),
+    )
+
+    def handle(self, *args, **options):
+        model = options['archived'] and ArchivedChangeset or Changeset
+        changesets = model.objects.select_related('content_type', 'changed_by', 'moderated_by').order_by('pk')
+        if options['content_types']:
+            changesets = changesets.filter(content_type__in=[get_content_type(label) for label in options['content_types']])
+        if options['statuses']:
+            changesets = changesets.filter(moderation_status__in=[parse_status(status) for status in options['statuses']])
+        if options['since']:
+            changesets = changesets.filter(date_created__gte=parse_date(options['since']))
+        if options['until']:
+            changesets = changesets.filter(date_created__lt=parse_date(options['until']))
+
+        stream = options['output'] and open(options['output'], 'w') or self.stdout
+        try:
+            total = self.export(changesets, stream, options['chunk_size'])
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+        sys.stderr.write("Exported %d changesets\n" % total)
+
+    def export(self, changesets, stream, chunk_size):
+        last_pk = 0
+        total = 0
+        while True:
+            chunk = list(changesets.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return total
+            last_pk = chunk[-1].pk
+            for cs in chunk:
+                stream.write(simplejson.dumps(serialize_changeset(cs), cls=DiffEncoder, sort_keys=True))
+                stream.write('\n')
+            total += len(chunk)
@@ -0,0 +1,176 @@
+from optparse import make_option
+import datetime
+import sys
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import simplejson
+
+from moderation.models import Changeset, ArchivedChangeset, ChangesetDependency, QueueCounter, MODERATION_PENDING_LIST, get_object_dependencies, prefetch_content_objects
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def changeset_key(content_type_id, object_pk, revision, date_created):
+    """
+    What makes a changeset the same one on import: its revision, or its creation date
+    for changesets never numbered by backfill_changeset_revisions.
+    """
+    if revision is not None:
+        return (content_type_id, object_pk, 'revision', revision)
+    return (content_type_id, object_pk, 'date', date_created)
+
+
+def parse_datetime(value):
+    if value is None:
+        return None
+    for format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise CommandError('Invalid date: %s' % value)
+
+
+class Command(BaseCommand):
+    help = "Loads changesets from JSON lines written by export_changesets"
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of changesets inserted per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import, or - for standard input')
+
+        self.content_types = {}
+        stream = args[0] == '-' and sys.stdin or open(args[0])
+
+        # date_created is auto_now_add, which would stamp every imported row with the import time
+        date_created = Changeset._meta.get_field('date_created')
+        date_created.auto_now_add = False
+        try:
+            imported, skipped = self.load(stream, options['batch_size'])
+        finally:
+            date_created.auto_now_add = True
+            if stream is not sys.stdin:
+                stream.close()
+
+        self.stdout.write("Imported %d changesets, skipped %d already present\n" % (imported, skipped))
+
+    def load(self, stream, batch_size):
+        imported = skipped = 0
+        batch = []
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                batch.append(simplejson.loads(line))
+            except ValueError:
+                raise CommandError('Line %d is not valid JSON' % line_number)
+            if len(batch) >= batch_size:
+                count = self.insert_batch(batch)
+                imported += count
+                skipped += len(batch) - count
+                batch = []
+        if batch:
+            count = self.insert_batch(batch)
+            imported += count
+            skipped += len(batch) - count
+        return imported, skipped
+
+    def get_content_type(self, natural_key):
+        natural_key = tuple(natural_key)
+        if natural_key not in self.content_types:
+            try:
+                self.content_types[natural_key] = ContentType.objects.get_by_natural_key(*natural_key)
+            except ContentType.DoesNotExist:
+                raise CommandError('Unknown content type: %s.%s' % natural_key)
+        return self.content_types[natural_key]
+
+    def get_existing_keys(self, records):
+        """
+        Keys of the changesets already present for the objects of records, live or archived.
+        """
+        by_content_type = {}
+        for r in records:
+            if r['object_pk'] is not None:
+                by_content_type.setdefault(self.get_content_type(r['content_type']).pk, set()).add(r['object_pk'])
+
+        existing = set()
+        for ct_id, object_pks in by_content_type.items():
+            for model in (Changeset, ArchivedChangeset):
+                history = model.objects.filter(content_type=ct_id, object_pk__in=object_pks)
+                for pk, revision, date_created in history.values_list('object_pk', 'revision', 'date_created'):
+                    existing.add(changeset_key(ct_id, pk, None, date_created))
+                    if revision is not None:
+                        existing.add(changeset_key(ct_id, pk, revision, date_created))
+        return existing
+
+    @transaction.commit_on_success
+    def insert_batch(self, records):
+        usernames = set(r['changed_by'] for r in records) | set(r['moderated_by'] for r in records)
+        users = dict(User.objects.filter(username__in=[u for u in usernames if u]).values_list('username', 'id'))
+
+        # duplicates within the batch are skipped too, the first one wins
+        seen = self.get_existing_keys(records)
+        changesets = []
+        deltas = {}
+        for r in records:
+            content_type = self.get_content_type(r['content_type'])
+            date_created = parse_datetime(r['date_created'])
+            key = changeset_key(content_type.pk, r['object_pk'], r['revision'], date_created)
+            if r['object_pk'] is not None and key in seen:
+                continue
+            seen.add(key)
+
+            cs = Changeset(
+                content_type=content_type,
+                object_pk=r['object_pk'],
+                date_created=date_created,
+                moderation_status=r['moderation_status'],
+                moderated_by_id=users.get(r['moderated_by']),
+                moderation_date=parse_datetime(r['moderation_date']),
+                moderation_reason=r['moderation_reason'],
+                changed_by_id=users.get(r['changed_by']),
+                revision=r['revision'],
+                creation=r['creation'],
+            )
+            cs.diff = r['diff']
+            changesets.append(cs)
+
+            ct_deltas = deltas.setdefault(content_type.pk, {})
+            ct_deltas[cs.moderation_status] = ct_deltas.get(cs.moderation_status, 0) + 1
+
+        Changeset.objects.bulk_create(changesets)
+        self.index_dependencies([cs for cs in changesets if cs.object_pk and cs.moderation_status in MODERATION_PENDING_LIST])
+        for content_type_id, ct_deltas in deltas.items():
+            QueueCounter.objects.record(content_type_id, ct_deltas)
+        return len(changesets)
+
+    def index_dependencies(self, changesets):
+        """
+        Builds the dependency rows get_children needs for imported pending changesets,
+        which bulk_create returned without their pks.
+        """
+        by_content_type = {}
+        for cs in changesets:
+            by_content_type.setdefault(cs.content_type_id, {})[changeset_key(cs.content_type_id, cs.object_pk,
+                cs.revision, cs.date_created)] = cs
+
+        saved = []
+        for ct_id, keys in by_content_type.items():
+            pending = Changeset.objects.filter(content_type=ct_id, object_pk__in=set(cs.object_pk for cs in keys.values()),
+                moderation_status__in=MODERATION_PENDING_LIST, dependencies=None)
+            saved.extend(cs for cs in pending
+                         if changeset_key(ct_id, cs.object_pk, cs.revision, cs.date_created) in keys)
+
+        ChangesetDependency.objects.bulk_create([
+            ChangesetDependency(changeset=cs, content_type_id=dep_ct_id, object_pk=dep_pk)
+            for cs in prefetch_content_objects(saved) if cs.content_object is not None
+            for dep_ct_id, dep_pk in get_object_dependencies(cs.content_object)
+        ])
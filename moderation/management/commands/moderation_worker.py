@@ -0,0 +1,76 @@
+from optparse import make_option
+import logging
+import threading
+import time
+import traceback
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from moderation.models import ApprovalJob, JOB_STATUS_QUEUED
+
+logger = logging.getLogger('moderation.worker')
+
+
+class Worker(threading.Thread):
+    def __init__(self, poll_interval, once):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self.once = once
+        self.processed = 0
+
+    def next_job(self):
+        candidates = ApprovalJob.objects.filter(status=JOB_STATUS_QUEUED).order_by('id').values_list('id', flat=True)[:10]
+        for job_id in candidates:
+            if ApprovalJob.objects.claim(job_id):
+                return ApprovalJob.objects.get(pk=job_id)
+        return None
+
+    def run(self):
+        try:
+            while True:
+                job = self.next_job()
+                if job is None and ApprovalJob.objects.requeue_stale():
+                    job = self.next_job()
+                if job is None:
+                    if self.once:
+                        return
+                    time.sleep(self.poll_interval)
+                    continue
+
+                try:
+                    job.run()
+                except Exception:
+                    logger.exception('Approval job %s failed', job.pk)
+                    job.finish(error=traceback.format_exc())
+                else:
+                    job.finish()
+                self.processed += 1
+        finally:
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = "Runs queued asynchronous approvals and rejections"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', type='int', dest='concurrency', default=2,
+            help='Number of jobs run in parallel'),
+        make_option('--poll-interval', type='float', dest='poll_interval', default=1.0,
+            help='Seconds to wait when the job queue is empty'),
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit when the job queue is empty'),
+    )
+
+    def handle(self, *args, **options):
+        workers = [Worker(options['poll_interval'], options['once']) for i in range(options['concurrency'])]
+        for worker in workers:
+            worker.start()
+        try:
+            while [w for w in workers if w.is_alive()]:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write("Processed %d jobs\n" % sum(w.processed for w in workers))
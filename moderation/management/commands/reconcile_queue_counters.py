@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from moderation.models import Changeset, ArchivedChangeset, QueueCounter, STATUS_COUNTER_FIELDS
+
+
+class Command(BaseCommand):
+    help = "Recounts changesets per content type and status and repairs the queue counters"
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        totals = {}
+        for manager in (Changeset.objects, ArchivedChangeset.objects):
+            for row in manager.values('content_type', 'moderation_status').annotate(count=Count('id')).order_by():
+                field = STATUS_COUNTER_FIELDS.get(row['moderation_status'])
+                if field:
+                    counts = totals.setdefault(row['content_type'], {})
+                    counts[field] = counts.get(field, 0) + row['count']
+
+        counters = dict((c.content_type_id, c) for c in QueueCounter.objects.select_for_update())
+        repaired = 0
+        for content_type_id in set(totals) | set(counters):
+            counts = dict((field, 0) for field in STATUS_COUNTER_FIELDS.values())
+            counts.update(totals.get(content_type_id, {}))
+
+            counter = counters.get(content_type_id)
+            if counter is None:
+                QueueCounter.objects.create(content_type_id=content_type_id, **counts)
+                repaired += 1
+            elif any(getattr(counter, field) != value for field, value in counts.items()):
+                QueueCounter.objects.filter(pk=counter.pk).update(**counts)
+                repaired += 1
+
+        self.stdout.write("Repaired %d counters\n" % repaired)
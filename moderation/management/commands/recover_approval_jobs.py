@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from moderation.models import ApprovalJob
+
+
+class Command(BaseCommand):
+    help = "Requeues, or with --fail reverts, approval jobs left running by a dead worker"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--timeout', type='int', dest='timeout', default=None,
+            help='Seconds after which a running job counts as stale (default MODERATION_JOB_TIMEOUT)'),
+        make_option('--fail', action='store_true', dest='fail', default=False,
+            help='Mark stale jobs as failed and give their changesets back their status instead'),
+    )
+
+    def handle(self, *args, **options):
+        if options['fail']:
+            count = ApprovalJob.objects.fail_stale(options['timeout'])
+            self.stdout.write("Failed %d stale jobs\n" % count)
+        else:
+            count = ApprovalJob.objects.requeue_stale(options['timeout'])
+            self.stdout.write("Requeued %d stale jobs\n" % count)
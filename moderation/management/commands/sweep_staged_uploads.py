@@ -0,0 +1,56 @@
+from optparse import make_option
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from moderation.models import Changeset, MODERATION_PENDING_LIST, MODERATION_STATUS_APPLYING
+from moderation.uploads import get_staging_dir, get_staging_storages, staged_names
+
+
+class Command(BaseCommand):
+    help = "Deletes staged uploads no pending changeset refers to any more"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age', default=24,
+            help='Only delete files staged more than this many hours ago'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=500,
+            help='Number of pending changesets read per query'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Only list the files that would be deleted'),
+    )
+
+    def handle(self, *args, **options):
+        referenced = self.referenced_names(options['chunk_size'])
+        cutoff = datetime.datetime.now() - datetime.timedelta(hours=options['min_age'])
+        staging_dir = get_staging_dir()
+
+        total = 0
+        for storage in get_staging_storages():
+            if not storage.exists(staging_dir.rstrip('/')):
+                continue
+            digests, files = storage.listdir(staging_dir)
+            for digest in digests:
+                for filename in storage.listdir(staging_dir + digest)[1]:
+                    name = '%s%s/%s' % (staging_dir, digest, filename)
+                    if name in referenced or storage.modified_time(name) > cutoff:
+                        continue
+                    if options['dry_run']:
+                        self.stdout.write("%s\n" % name)
+                    else:
+                        storage.delete(name)
+                    total += 1
+
+        self.stdout.write("%s %d staged files\n" % (options['dry_run'] and 'Would delete' or 'Deleted', total))
+
+    def referenced_names(self, chunk_size):
+        changesets = Changeset.objects.filter(
+            moderation_status__in=MODERATION_PENDING_LIST + (MODERATION_STATUS_APPLYING,)).order_by('pk')
+        referenced = set()
+        last_pk = 0
+        while True:
+            chunk = list(changesets.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return referenced
+            last_pk = chunk[-1].pk
+            for cs in chunk:
+                referenced |= staged_names(cs.diff)
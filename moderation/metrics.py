@@ -0,0 +1,164 @@
+import logging
+import socket
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('moderation.metrics')
+
+
+class NullBackend(object):
+    enabled = False
+
+    def timing(self, name, ms):
+        pass
+
+    def histogram(self, name, value):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+class LoggingBackend(NullBackend):
+    enabled = True
+
+    def timing(self, name, ms):
+        logger.info('%s %.1fms', name, ms)
+
+    def histogram(self, name, value):
+        logger.info('%s %s', name, value)
+
+    def gauge(self, name, value):
+        logger.info('%s = %s', name, value)
+
+
+class StatsdBackend(NullBackend):
+    """
+    Sends metrics to a statsd daemon over UDP; losing a packet never fails the caller.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.address = (getattr(settings, 'MODERATION_STATSD_HOST', 'localhost'),
+                        getattr(settings, 'MODERATION_STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'MODERATION_STATSD_PREFIX', 'moderation')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, name, value, kind):
+        try:
+            self.socket.sendto('%s.%s:%s|%s' % (self.prefix, name, value, kind), self.address)
+        except socket.error:
+            pass
+
+    def timing(self, name, ms):
+        self.send(name, int(round(ms)), 'ms')
+
+    def histogram(self, name, value):
+        self.send(name, value, 'h')
+
+    def gauge(self, name, value):
+        self.send(name, value, 'g')
+
+
+BACKENDS = {
+    'logging': LoggingBackend,
+    'statsd': StatsdBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """
+    The MODERATION_METRICS_BACKEND backend: 'logging', 'statsd' or the dotted path of a
+    class with the NullBackend interface. Metrics are off when it is not set.
+    """
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'MODERATION_METRICS_BACKEND', None)
+        if not name:
+            backend_class = NullBackend
+        elif name in BACKENDS:
+            backend_class = BACKENDS[name]
+        else:
+            module, attr = name.rsplit('.', 1)
+            backend_class = getattr(import_module(module), attr)
+        _backend = backend_class()
+    return _backend
+
+
+def content_type_name(content_type_id):
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    return '%s.%s' % (content_type.app_label, content_type.model)
+
+
+class timer(object):
+    """
+    Context manager reporting the wall time of a block as name, and the number of
+    queries it ran as name.queries when MODERATION_METRICS_QUERIES is on.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.backend = get_backend()
+        if not self.backend.enabled:
+            return self
+
+        self.count_queries = getattr(settings, 'MODERATION_METRICS_QUERIES', True)
+        if self.count_queries:
+            self.use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            self.first_query = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.backend.enabled:
+            return False
+
+        self.backend.timing(self.name, (time.time() - self.start) * 1000)
+        if self.count_queries:
+            self.backend.histogram('%s.queries' % self.name, len(connection.queries) - self.first_query)
+            connection.use_debug_cursor = self.use_debug_cursor
+            # outside DEBUG nothing else empties the query log, so the outermost timer does
+            if not self.use_debug_cursor and not settings.DEBUG:
+                del connection.queries[self.first_query:]
+        return False
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not get_backend().enabled:
+                return func(*args, **kwargs)
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_decisions(changesets):
+    """
+    Reports the time from creation to decision of decided changesets, per content type.
+    """
+    backend = get_backend()
+    if not backend.enabled:
+        return
+    for cs in changesets:
+        if cs.moderation_date and cs.date_created:
+            delta = cs.moderation_date - cs.date_created
+            backend.timing('time_to_decision.%s' % content_type_name(cs.content_type_id),
+                (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds / 1000.0)
+
+
+def record_queue_depth(content_type_id, depth):
+    backend = get_backend()
+    if backend.enabled:
+        backend.gauge('queue_depth.%s' % content_type_name(content_type_id), depth)
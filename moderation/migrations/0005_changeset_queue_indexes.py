@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+PENDING_INDEX_NAME = 'moderation_changeset_pending_idx'
+
+# MODERATION_PENDING_LIST, frozen at the time of this migration
+PENDING_STATUSES = (2, 3)
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'Changeset', fields ['content_type', 'object_pk', 'moderation_status']
+        db.create_index('moderation_changeset', ['content_type_id', 'object_pk', 'moderation_status'])
+
+        # Adding index on 'Changeset', fields ['moderation_status', 'id']
+        db.create_index('moderation_changeset', ['moderation_status', 'id'])
+
+        # Adding index on 'Changeset', fields ['moderation_status', 'date_created']
+        db.create_index('moderation_changeset', ['moderation_status', 'date_created'])
+
+        # Partial index over the pending queue only, where the backend supports it
+        if db.backend_name in ('postgres', 'sqlite3'):
+            db.execute('CREATE INDEX %s ON moderation_changeset (id, content_type_id) WHERE moderation_status IN (%s)' % (
+                PENDING_INDEX_NAME, ', '.join(map(str, PENDING_STATUSES))))
+
+    def backwards(self, orm):
+        if db.backend_name in ('postgres', 'sqlite3'):
+            db.execute('DROP INDEX %s' % PENDING_INDEX_NAME)
+
+        # Removing index on 'Changeset', fields ['moderation_status', 'date_created']
+        db.delete_index('moderation_changeset', ['moderation_status', 'date_created'])
+
+        # Removing index on 'Changeset', fields ['moderation_status', 'id']
+        db.delete_index('moderation_changeset', ['moderation_status', 'id'])
+
+        # Removing index on 'Changeset', fields ['content_type', 'object_pk', 'moderation_status']
+        db.delete_index('moderation_changeset', ['content_type_id', 'object_pk', 'moderation_status'])
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'moderation.changeset': {
+            'Meta': {'object_name': 'Changeset'},
+            'changed_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'changed_by_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'moderated_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'moderated_by_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'moderation_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'moderation_reason': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'moderation_status': ('django.db.models.fields.SmallIntegerField', [], {'default': '2'}),
+            'object_diff': ('picklefield.fields.PickledObjectField', [], {}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'})
+        },
+        'moderation.changesetdependency': {
+            'Meta': {'unique_together': "(('changeset', 'content_type', 'object_pk'),)", 'object_name': 'ChangesetDependency'},
+            'changeset': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dependencies'", 'to': "orm['moderation.Changeset']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['moderation']
\ No newline at end of file
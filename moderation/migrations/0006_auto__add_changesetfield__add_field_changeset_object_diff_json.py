@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'ChangesetField'
+        db.create_table('moderation_changesetfield', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('changeset', self.gf('django.db.models.fields.related.ForeignKey')(related_name='fields', to=orm['moderation.Changeset'])),
+            ('field_name', self.gf('django.db.models.fields.CharField')(max_length=100, db_index=True)),
+            ('value_hash', self.gf('django.db.models.fields.CharField')(max_length=40)),
+        ))
+        db.send_create_signal('moderation', ['ChangesetField'])
+
+        # Adding unique constraint on 'ChangesetField', fields ['changeset', 'field_name']
+        db.create_unique('moderation_changesetfield', ['changeset_id', 'field_name'])
+
+        # Adding field 'Changeset.object_diff_json'
+        db.add_column('moderation_changeset', 'object_diff_json',
+                      self.gf('django.db.models.fields.TextField')(null=True, blank=True),
+                      keep_default=False)
+
+        # Changing field 'Changeset.object_diff'
+        db.alter_column('moderation_changeset', 'object_diff', self.gf('picklefield.fields.PickledObjectField')(null=True))
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'ChangesetField', fields ['changeset', 'field_name']
+        db.delete_unique('moderation_changesetfield', ['changeset_id', 'field_name'])
+
+        # Deleting model 'ChangesetField'
+        db.delete_table('moderation_changesetfield')
+
+        # Deleting field 'Changeset.object_diff_json'
+        db.delete_column('moderation_changeset', 'object_diff_json')
+
+        # User chose to not deal with backwards NULL issues for 'Changeset.object_diff'
+        raise RuntimeError("Cannot reverse this migration. 'Changeset.object_diff' and its values cannot be restored.")
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'moderation.changeset': {
+            'Meta': {'object_name': 'Changeset'},
+            'changed_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'changed_by_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'moderated_by': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'moderated_by_set'", 'null': 'True', 'to': "orm['auth.User']"}),
+            'moderation_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'moderation_reason': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'moderation_status': ('django.db.models.fields.SmallIntegerField', [], {'default': '2'}),
+            'object_diff': ('picklefield.fields.PickledObjectField', [], {'null': 'True'}),
+            'object_diff_json': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField', [], {'null': 'True'})
+        },
+        'moderation.changesetdependency': {
+            'Meta': {'unique_together': "(('changeset', 'content_type', 'object_pk'),)", 'object_name': 'ChangesetDependency'},
+            'changeset': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dependencies'", 'to': "orm['moderation.Changeset']"}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_pk': ('django.db.models.fields.PositiveIntegerField', [], {'db_index': 'True'})
+        },
+        'moderation.changesetfield': {
+            'Meta': {'unique_together': "(('changeset', 'field_name'),)", 'object_name': 'ChangesetField'},
+            'changeset': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'fields'", 'to': "orm['moderation.Changeset']"}),
+            'field_name': ('django.db.models.fields.CharField', [], {'max_length': '100', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value_hash': ('django.db.models.fields.CharField', [], {'max_length': '40'})
+        }
+    }
+
+    complete_apps = ['moderation']
\ No newline at end of file
@@ -1,20 +1,29 @@
 import datetime
-import random
+from functools import wraps
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction, connection
+from django.db.models import Max, Count, F, Sum, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.db.utils import IntegrityError
-from moderation.diff import calculate_full_diff
+from moderation import metrics
+from moderation.apply import get_apply_plan, resolve_slug
+from moderation.cache import render_changeset_diff, invalidate_object
+from moderation.diff import RelatedLabels
+from moderation.storage import encode_diff, decode_diff, hash_value, get_diff_storage, field_index_enabled, DIFF_STORAGE_JSON
 
 from picklefield.fields import PickledObjectField
-from tagging.utils import parse_tag_input
 
 
 MODERATION_STATUS_REJECTED = 0
 MODERATION_STATUS_APPROVED = 1
 MODERATION_STATUS_PENDING = 2
 MODERATION_STATUS_CREATED = 3
+MODERATION_STATUS_APPLYING = 4
 
 MODERATION_PENDING_LIST = (MODERATION_STATUS_PENDING, MODERATION_STATUS_CREATED)
 
@@ -23,9 +32,161 @@ STATUS_CHOICES = (
     (MODERATION_STATUS_PENDING, "Pending"),
     (MODERATION_STATUS_REJECTED, "Rejected"),
     (MODERATION_STATUS_CREATED, "Created"),
+    (MODERATION_STATUS_APPLYING, "Applying"),
 )
 
 
+REVISION_RETRIES = 5
+
+LEASE_SECONDS = 900
+LEASE_BATCH = 10
+
+
+def in_transaction(func):
+    """
+    Runs func in the caller's transaction when it manages one, and in a commit_on_success
+    of its own otherwise. Without a managed transaction every save commits by itself, and
+    releasing or rolling back a savepoint taken before it fails.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wrapper
+
+
+def skip_locked_supported():
+    return connection.vendor == 'postgresql' and getattr(connection, 'pg_version', 0) >= 90500
+
+
+class ChangesetManager(models.Manager):
+    def touching_field(self, field_name):
+        return self.get_query_set().filter(fields__field_name=field_name)
+
+    def next_revision(self, content_type, object_pk):
+        return self.next_revisions(content_type, [object_pk])[object_pk]
+
+    def next_revisions(self, content_type, object_pks):
+        latest = dict((pk, 0) for pk in object_pks)
+        counts = dict((pk, 0) for pk in object_pks)
+        for manager in (self, ArchivedChangeset.objects):
+            history = manager.filter(content_type=content_type, object_pk__in=object_pks)
+            for row in history.values('object_pk').annotate(Max('revision'), Count('id')).order_by():
+                latest[row['object_pk']] = max(latest[row['object_pk']], row['revision__max'] or 0)
+                counts[row['object_pk']] += row['id__count']
+        return dict((pk, max(latest[pk], counts[pk]) + 1) for pk in object_pks)
+
+    @in_transaction
+    def create_revision(self, content_type, object_pk, **kwargs):
+        """
+        Creates a changeset numbered after the object's previous ones, retrying
+        when a concurrent writer took the same revision number.
+        """
+        for attempt in range(REVISION_RETRIES):
+            revision = object_pk and self.next_revision(content_type, object_pk) or None
+            sid = transaction.savepoint()
+            try:
+                changeset = self.create(content_type=content_type, object_pk=object_pk,
+                    revision=revision, creation=revision == 1, **kwargs)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == REVISION_RETRIES - 1:
+                    raise
+            else:
+                transaction.savepoint_commit(sid)
+                return changeset
+
+    def latest_pending(self, content_type, object_pk):
+        changesets = self.get_query_set().filter(content_type=content_type, object_pk=object_pk,
+            moderation_status__in=MODERATION_PENDING_LIST).order_by('-revision', '-id')
+        try:
+            return changesets[0]
+        except IndexError:
+            return None
+
+    def available(self, now=None):
+        """
+        Pending changesets nobody holds an unexpired lease on.
+        """
+        return self.get_query_set().filter(moderation_status__in=MODERATION_PENDING_LIST).filter(
+            Q(lease_expires=None) | Q(lease_expires__lt=now or datetime.datetime.now()))
+
+    @transaction.commit_on_success
+    def checkout(self, user, count=None, lease_seconds=None):
+        """
+        Leases up to count pending changesets to user and returns them, oldest first.
+        Changesets the user already holds are renewed and returned first, so moderators
+        working through their batch keep getting the same items.
+        """
+        count = count or getattr(settings, 'MODERATION_LEASE_BATCH', LEASE_BATCH)
+        lease_seconds = lease_seconds or getattr(settings, 'MODERATION_LEASE_SECONDS', LEASE_SECONDS)
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+
+        held = self.get_query_set().filter(moderation_status__in=MODERATION_PENDING_LIST,
+            leased_by=user, lease_expires__gte=now)
+        pks = list(held.order_by('id').values_list('id', flat=True)[:count])
+        if pks:
+            self.get_query_set().filter(pk__in=pks).update(lease_expires=expires)
+
+        if len(pks) < count:
+            if skip_locked_supported():
+                pks.extend(self._lease_skip_locked(user, count - len(pks), now, expires))
+            else:
+                pks.extend(self._lease_compare_and_set(user, count - len(pks), now, expires))
+
+        return prefetch_content_objects(self.get_query_set().filter(pk__in=pks).order_by('id'))
+
+    def _lease_skip_locked(self, user, count, now, expires):
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        cursor = connection.cursor()
+        cursor.execute(
+            'UPDATE %(table)s SET leased_by_id = %%s, lease_expires = %%s WHERE id IN ('
+            'SELECT id FROM %(table)s WHERE moderation_status IN %%s AND (lease_expires IS NULL OR lease_expires < %%s) '
+            'ORDER BY id LIMIT %%s FOR UPDATE SKIP LOCKED) RETURNING id' % {'table': table},
+            [user.pk, expires, tuple(MODERATION_PENDING_LIST), now, count])
+        transaction.set_dirty()
+        return [row[0] for row in cursor.fetchall()]
+
+    def _lease_compare_and_set(self, user, count, now, expires):
+        leased = []
+        last_pk = 0
+        while len(leased) < count:
+            candidates = list(self.available(now).filter(pk__gt=last_pk).order_by('id').values_list('id', flat=True)[:count])
+            if not candidates:
+                break
+            for pk in candidates:
+                last_pk = pk
+                if self.available(now).filter(pk=pk).update(leased_by=user, lease_expires=expires):
+                    leased.append(pk)
+                    if len(leased) == count:
+                        break
+        return leased
+
+    def claim_for_decision(self, user, pks, lease_seconds=None):
+        """
+        Leases to user those of the changesets with the given pks that are pending and not
+        leased to anybody else, and returns the set of pks user now holds. Deciding a
+        changeset ends its lease, so a second moderator cannot decide it again.
+        """
+        pks = list(pks)
+        if not pks:
+            return set()
+        lease_seconds = lease_seconds or getattr(settings, 'MODERATION_LEASE_SECONDS', LEASE_SECONDS)
+        now = datetime.datetime.now()
+        pending = self.get_query_set().filter(pk__in=pks, moderation_status__in=MODERATION_PENDING_LIST)
+        pending.filter(Q(leased_by=user) | Q(lease_expires=None) | Q(lease_expires__lt=now)).update(
+            leased_by=user, lease_expires=now + datetime.timedelta(seconds=lease_seconds))
+        return set(pending.filter(leased_by=user, lease_expires__gte=now).values_list('id', flat=True))
+
+    def release(self, user, changesets=None):
+        leases = self.get_query_set().filter(leased_by=user)
+        if changesets is not None:
+            leases = leases.filter(pk__in=[cs.pk for cs in changesets])
+        return leases.update(leased_by=None, lease_expires=None)
+
+
 class Changeset(models.Model):
     content_type = models.ForeignKey(ContentType, editable=False)
     object_pk = models.PositiveIntegerField(editable=False, null=True)
@@ -38,26 +199,95 @@ class Changeset(models.Model):
     moderation_reason = models.TextField(blank=True, null=True)
 
     changed_by = models.ForeignKey('auth.User', editable=False, null=True, related_name='changed_by_set')
-    object_diff = PickledObjectField(editable=False)
+    object_diff = PickledObjectField(editable=False, null=True)
+    object_diff_json = models.TextField(editable=False, blank=True, null=True)
+
+    revision = models.PositiveIntegerField(editable=False, null=True)
+    creation = models.BooleanField(editable=False, default=False)
+
+    leased_by = models.ForeignKey('auth.User', editable=False, null=True, related_name='leased_changeset_set')
+    lease_expires = models.DateTimeField(editable=False, blank=True, null=True)
+
+    objects = ChangesetManager()
+
+    is_archived = False
+
+    class Meta:
+        unique_together = (('content_type', 'object_pk', 'revision'),)
+
+    def _get_diff(self):
+        if self.object_diff_json is not None:
+            if not hasattr(self, '_diff_cache'):
+                self._diff_cache = decode_diff(self.object_diff_json)
+            return self._diff_cache
+        return self.object_diff or {}
+
+    def _set_diff(self, data):
+        if get_diff_storage() == DIFF_STORAGE_JSON:
+            self.object_diff_json = encode_diff(data)
+            self.object_diff = None
+            self._diff_cache = decode_diff(self.object_diff_json)
+        else:
+            self.object_diff = data
+            self.object_diff_json = None
+
+    diff = property(_get_diff, _set_diff)
+
+    def update_field_index(self):
+        if not field_index_enabled():
+            return
+
+        ChangesetField.objects.filter(changeset=self).delete()
+        ChangesetField.objects.bulk_create([
+            ChangesetField(changeset=self, field_name=k, value_hash=hash_value(v))
+            for k, v in self.diff.items()
+        ])
+
+    def delete(self, *args, **kwargs):
+        QueueCounter.objects.record(self.content_type_id, {self.moderation_status: -1})
+        super(Changeset, self).delete(*args, **kwargs)
 
     def get_model_name(self):
         return self.content_type.name
 
+    @metrics.timed('get_children')
     def get_children(self):
-        changesets = Changeset.objects.filter(moderation_status__in=MODERATION_PENDING_LIST)
-        for cs in changesets:
-            obj = cs.content_object
-            if not obj:
-                continue
+        if not self.object_pk:
+            return []
+
+        return prefetch_related_labels(prefetch_content_objects(Changeset.objects.filter(
+            moderation_status__in=MODERATION_PENDING_LIST,
+            dependencies__content_type=self.content_type_id,
+            dependencies__object_pk=self.object_pk,
+        ).exclude(pk=self.pk).distinct().order_by('id')))
+
+    def update_dependencies(self, obj=None):
+        """
+        Rebuilds the (parent content type, parent pk) rows this changeset depends on,
+        taken from the FK values of the moderated object.
+        """
+        if obj is None:
+            obj = self.content_object
+
+        ChangesetDependency.objects.filter(changeset=self).delete()
+        if obj is None:
+            return
+
+        ChangesetDependency.objects.bulk_create([
+            ChangesetDependency(changeset=self, content_type_id=ct_id, object_pk=pk)
+            for ct_id, pk in get_object_dependencies(obj)
+        ])
 
-            for f in obj._meta.fields:
-                if getattr(obj, f.name, None) == self.content_object:
-                    yield cs
+    def get_rendered_diff(self):
+        return render_changeset_diff(self)
+
+    def get_history(self):
+        return get_history(self.content_type_id, self.object_pk)
 
     def get_changes_data(self):
         return {
             'obj': self,
-            'diff': calculate_full_diff(self.content_object, self.object_diff),
+            'diff': self.get_rendered_diff(),
             'children':self.get_children(),
         }
 
@@ -69,80 +299,489 @@ class Changeset(models.Model):
 
     @property
     def is_creation(self):
+        if self.revision is not None:
+            return self.creation
         old_cs = Changeset.objects.filter(content_type=self.content_type, object_pk=self.object_pk, pk__lt=self.pk)
         return not old_cs.exists()
 
+    @metrics.timed('approve')
     def approve(self, user, reason):
         self.apply_changes()
 
+        QueueCounter.objects.record(self.content_type_id, {self.moderation_status: -1, MODERATION_STATUS_APPROVED: 1})
         self.moderation_status = MODERATION_STATUS_APPROVED
         self.moderated_by = user
         self.moderation_date = datetime.datetime.now()
         self.moderation_reason = reason
+        self.leased_by = self.lease_expires = None
 
         self.save()
+        metrics.record_decisions([self])
 
+    @metrics.timed('reject')
     def reject(self, user, reason):
+        QueueCounter.objects.record(self.content_type_id, {self.moderation_status: -1, MODERATION_STATUS_REJECTED: 1})
         self.moderation_status = MODERATION_STATUS_REJECTED
         self.moderated_by = user
         self.moderation_date = datetime.datetime.now()
         self.moderation_reason = reason
+        self.leased_by = self.lease_expires = None
         self.save()
+        invalidate_object(self.content_type_id, self.object_pk)
+        metrics.record_decisions([self])
+
+    def approve_with_children(self, user, reason):
+        children = self.get_children()
+        self.approve(user, reason)
+        for c in children:
+            c.approve(user, reason)
+            [c1.approve(user, reason) for c1 in c.get_children()]
+
+    def reject_with_children(self, user, reason):
+        children = self.get_children()
+        self.reject(user, reason)
+        for c in children:
+            c.reject(user, reason)
+            [c1.reject(user, reason) for c1 in c.get_children()]
+
+    def get_lease_holder(self):
+        if self.lease_expires and self.lease_expires >= datetime.datetime.now():
+            return self.leased_by
+        return None
 
-    def apply_changes(self):
+    @property
+    def is_applying(self):
+        return self.moderation_status == MODERATION_STATUS_APPLYING
+
+    @metrics.timed('apply_changes')
+    def apply_changes(self, obj=None, reserved_slugs=None):
+        """
+        Writes the diff to the object and returns the values written.
+        """
         if not self.object_pk:
-            return
+            return {}
 
         Model = self.content_type.model_class()
-        obj_fields = dict([(f[0].name, f[0]) for f in Model()._meta.get_fields_with_model()])
-        update_params = {}
-        for k,v in self.object_diff.items():
-            field = obj_fields.get(k)
-            if not field:
-                continue
-
-            if not field.editable:
-                continue
-
-            if v is None:
-                if not field.null or not field.blank:
-                    continue
-
-            if 'FileBrowseField' in type(field).__name__:
-                from filebrowser.fields import FileObject
-                v = FileObject(u'%s%s' % (settings.FILEBROWSER_DIRECTORY, v))
-
-            if 'TagField' in type(field).__name__:
-                from tagging.models import Tag
-                tags = parse_tag_input(v)
-                lower_tags = []
-                real_tags = []
-                for t in tags:
-                    if not t.lower() in lower_tags:
-                        lower_tags.append(t.lower())
-                        real_tags.append(t)
-                real_tags_str = ', '.join('"%s"' % t for t in real_tags)
-                Tag.objects.update_tags(self.content_object, real_tags_str)
-
-            if getattr(field, 'rel', None) and isinstance(v, int):
-                v = field.rel.to(pk=v)
-
-            update_params[k] = v
-
+        plan = get_apply_plan(Model)
+        update_params = plan.get_update_params(self, self.diff, obj, reserved_slugs)
         update_params.update(moderation_active=True)
-        update_qs = Model.all_objects.filter(pk=self.object_pk)
-
-        if 'slug' in update_params:
-            siblings = Model.all_objects.exclude(pk=self.pk)
-            update_params['slug'] = update_params['slug'][:50]
-            while siblings.filter(slug=update_params['slug']).exists():
-                update_params['slug'] += '_%s' % random.randint(10, 99)
-                update_params['slug'] = update_params['slug'][-50:]
-            update_params['slug'] = update_params['slug'][:50]
-        
-        update_qs.update(**update_params)
-
-class ModeratedManager(models.Manager):
+        Model.all_objects.filter(pk=self.object_pk).update(**update_params)
+        plan.apply_m2m(obj or self.content_object, self.diff)
+        invalidate_object(self.content_type_id, self.object_pk)
+        return update_params
+
+
+def prefetch_content_objects(changesets):
+    """
+    Resolves content_object for a list of changesets with one in_bulk per content type
+    and returns them as a list.
+    """
+    changesets = list(changesets)
+    pks_by_type = {}
+    for cs in changesets:
+        if cs.object_pk:
+            pks_by_type.setdefault(cs.content_type_id, set()).add(cs.object_pk)
+
+    objects_by_type = {}
+    for ct_id, pks in pks_by_type.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        objects_by_type[ct_id] = model and model._base_manager.in_bulk(list(pks)) or {}
+
+    for cs in changesets:
+        cs._content_type_cache = ContentType.objects.get_for_id(cs.content_type_id)
+        cs._content_object_cache = objects_by_type.get(cs.content_type_id, {}).get(cs.object_pk)
+    return changesets
+
+
+def prefetch_related_labels(changesets):
+    """
+    Lets the diffs of a list of changesets share one lookup of the FK and M2M labels they
+    show, loaded the first time one of them is rendered; returns the list.
+    """
+    related = RelatedLabels((cs.content_object, cs.diff) for cs in changesets if cs.content_object is not None)
+    for cs in changesets:
+        cs._related_labels = related
+    return changesets
+
+
+class ChangesetDependency(models.Model):
+    changeset = models.ForeignKey(Changeset, related_name='dependencies')
+    content_type = models.ForeignKey(ContentType)
+    object_pk = models.PositiveIntegerField(db_index=True)
+
+    class Meta:
+        unique_together = (('changeset', 'content_type', 'object_pk'),)
+
+
+class ChangesetField(models.Model):
+    changeset = models.ForeignKey(Changeset, related_name='fields')
+    field_name = models.CharField(max_length=100, db_index=True)
+    value_hash = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('changeset', 'field_name'),)
+
+
+STATUS_COUNTER_FIELDS = {
+    MODERATION_STATUS_PENDING: 'pending',
+    MODERATION_STATUS_CREATED: 'created',
+    MODERATION_STATUS_APPROVED: 'approved',
+    MODERATION_STATUS_REJECTED: 'rejected',
+    MODERATION_STATUS_APPLYING: 'applying',
+}
+
+
+class QueueCounterManager(models.Manager):
+    @in_transaction
+    def record(self, content_type_id, deltas):
+        """
+        Atomically adds deltas, a {moderation status: count} dict, to the counters
+        of a content type.
+        """
+        deltas = dict((STATUS_COUNTER_FIELDS[status], delta) for status, delta in deltas.items()
+                      if delta and status in STATUS_COUNTER_FIELDS)
+        if not deltas:
+            return
+
+        update = dict((name, F(name) + delta) for name, delta in deltas.items())
+        if self.filter(content_type=content_type_id).update(**update):
+            if metrics.get_backend().enabled:
+                metrics.record_queue_depth(content_type_id, get_queue_depth(content_type_id))
+            return
+
+        sid = transaction.savepoint()
+        try:
+            self.create(content_type_id=content_type_id, **deltas)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            self.filter(content_type=content_type_id).update(**update)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def record_queryset(self, changesets, status):
+        """
+        Records moving every changeset of a queryset to status; call before updating it.
+        """
+        for row in changesets.values('content_type', 'moderation_status').annotate(count=Count('id')):
+            self.record(row['content_type'], {row['moderation_status']: -row['count'], status: row['count']})
+
+
+class QueueCounter(models.Model):
+    content_type = models.ForeignKey(ContentType, unique=True)
+    pending = models.IntegerField(default=0)
+    created = models.IntegerField(default=0)
+    approved = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    applying = models.IntegerField(default=0)
+
+    objects = QueueCounterManager()
+
+    @property
+    def queue_depth(self):
+        return self.pending + self.created
+
+
+def get_queue_depth(content_type=None):
+    counters = QueueCounter.objects.all()
+    if content_type is not None:
+        counters = counters.filter(content_type=content_type)
+    totals = counters.aggregate(Sum('pending'), Sum('created'))
+    return (totals['pending__sum'] or 0) + (totals['created__sum'] or 0)
+
+
+def get_queue_stats():
+    return QueueCounter.objects.select_related('content_type').order_by('content_type__app_label', 'content_type__model')
+
+
+JOB_ACTION_APPROVE = 'approve'
+JOB_ACTION_REJECT = 'reject'
+
+JOB_ACTION_CHOICES = (
+    (JOB_ACTION_APPROVE, "Approve"),
+    (JOB_ACTION_REJECT, "Reject"),
+)
+
+JOB_TIMEOUT = 600
+
+JOB_STATUS_QUEUED = 0
+JOB_STATUS_RUNNING = 1
+JOB_STATUS_DONE = 2
+JOB_STATUS_FAILED = 3
+
+JOB_STATUS_CHOICES = (
+    (JOB_STATUS_QUEUED, "Queued"),
+    (JOB_STATUS_RUNNING, "Running"),
+    (JOB_STATUS_DONE, "Done"),
+    (JOB_STATUS_FAILED, "Failed"),
+)
+
+
+def async_approval_enabled():
+    return getattr(settings, 'MODERATION_ASYNC_APPROVAL', False)
+
+
+class ApprovalJobManager(models.Manager):
+    @transaction.commit_on_success
+    def enqueue(self, changeset, action, user, reason, cascade=True):
+        """
+        Records a decision to be run by the moderation_worker command and marks the
+        changeset as applying until then.
+        """
+        job = self.create(changeset=changeset, action=action, user=user, reason=reason,
+            cascade=cascade, previous_status=changeset.moderation_status)
+        QueueCounter.objects.record(changeset.content_type_id, {changeset.moderation_status: -1, MODERATION_STATUS_APPLYING: 1})
+        Changeset.objects.filter(pk=changeset.pk).update(moderation_status=MODERATION_STATUS_APPLYING)
+        changeset.moderation_status = MODERATION_STATUS_APPLYING
+        return job
+
+    def claim(self, job_id):
+        return self.filter(pk=job_id, status=JOB_STATUS_QUEUED).update(
+            status=JOB_STATUS_RUNNING, date_started=datetime.datetime.now()) == 1
+
+    def stale(self, timeout=None):
+        """
+        Running jobs started more than timeout seconds ago, whose worker most likely died.
+        """
+        timeout = timeout or getattr(settings, 'MODERATION_JOB_TIMEOUT', JOB_TIMEOUT)
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+        return self.filter(status=JOB_STATUS_RUNNING, date_started__lt=cutoff)
+
+    def requeue_stale(self, timeout=None):
+        """
+        Puts stale running jobs back in the queue. A job runs in one transaction, so a
+        dead worker left nothing applied; run() skips changesets already decided.
+        """
+        return self.stale(timeout).update(status=JOB_STATUS_QUEUED, date_started=None)
+
+    def fail_stale(self, timeout=None):
+        """
+        Marks stale running jobs as failed and gives their changesets back their status.
+        """
+        failed = 0
+        for job in self.stale(timeout):
+            if self.filter(pk=job.pk, status=JOB_STATUS_RUNNING).update(status=JOB_STATUS_FAILED):
+                job.finish(error=u'Worker did not finish the job in time')
+                failed += 1
+        return failed
+
+
+class ApprovalJob(models.Model):
+    changeset = models.ForeignKey(Changeset, related_name='jobs')
+    action = models.CharField(max_length=10, choices=JOB_ACTION_CHOICES)
+    user = models.ForeignKey('auth.User', null=True)
+    reason = models.TextField(blank=True, null=True)
+    cascade = models.BooleanField(default=True)
+    previous_status = models.SmallIntegerField(choices=STATUS_CHOICES)
+
+    status = models.SmallIntegerField(choices=JOB_STATUS_CHOICES, default=JOB_STATUS_QUEUED, db_index=True)
+    error = models.TextField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(blank=True, null=True)
+    date_finished = models.DateTimeField(blank=True, null=True)
+
+    objects = ApprovalJobManager()
+
+    @transaction.commit_on_success
+    def run(self):
+        changeset = Changeset.objects.select_for_update().get(pk=self.changeset_id)
+        if changeset.moderation_status != MODERATION_STATUS_APPLYING:
+            # already decided by an earlier run of a requeued job
+            return
+        if self.action == JOB_ACTION_APPROVE:
+            decide = self.cascade and changeset.approve_with_children or changeset.approve
+        else:
+            decide = self.cascade and changeset.reject_with_children or changeset.reject
+        decide(self.user, self.reason)
+
+    def finish(self, error=None):
+        if error is not None:
+            changeset = Changeset.objects.get(pk=self.changeset_id)
+            reverted = Changeset.objects.filter(pk=changeset.pk, moderation_status=MODERATION_STATUS_APPLYING).update(
+                moderation_status=self.previous_status)
+            if reverted:
+                QueueCounter.objects.record(changeset.content_type_id, {MODERATION_STATUS_APPLYING: -1, self.previous_status: 1})
+                invalidate_object(changeset.content_type_id, changeset.object_pk)
+        ApprovalJob.objects.filter(pk=self.pk).update(
+            status=error is None and JOB_STATUS_DONE or JOB_STATUS_FAILED,
+            error=error, date_finished=datetime.datetime.now())
+
+
+class ArchivedChangeset(models.Model):
+    """
+    Decided changeset moved out of the hot table by the archive_changesets command.
+    """
+    original_id = models.PositiveIntegerField(unique=True)
+    content_type = models.ForeignKey(ContentType)
+    object_pk = models.PositiveIntegerField(null=True)
+    content_object = generic.GenericForeignKey(ct_field="content_type", fk_field="object_pk")
+    date_created = models.DateTimeField()
+
+    moderation_status = models.SmallIntegerField(choices=STATUS_CHOICES)
+    moderated_by = models.ForeignKey('auth.User', null=True, related_name='archived_moderated_by_set')
+    moderation_date = models.DateTimeField(blank=True, null=True)
+    moderation_reason = models.TextField(blank=True, null=True)
+
+    changed_by = models.ForeignKey('auth.User', null=True, related_name='archived_changed_by_set')
+    object_diff = PickledObjectField(null=True)
+    object_diff_json = models.TextField(blank=True, null=True)
+
+    revision = models.PositiveIntegerField(null=True)
+    creation = models.BooleanField(default=False)
+    date_archived = models.DateTimeField(auto_now_add=True)
+
+    is_archived = True
+
+    @property
+    def diff(self):
+        return decode_stored_diff(self.object_diff, self.object_diff_json)
+
+    @property
+    def is_creation(self):
+        return self.creation
+
+
+ARCHIVED_FIELDS = ('content_type_id', 'object_pk', 'date_created', 'moderation_status', 'moderated_by_id',
+                   'moderation_date', 'moderation_reason', 'changed_by_id', 'object_diff', 'object_diff_json',
+                   'revision', 'creation')
+
+
+def get_history(content_type, object_pk):
+    """
+    Every changeset of an object, from both the live and the archive table, oldest first.
+    """
+    live = Changeset.objects.filter(content_type=content_type, object_pk=object_pk)
+    archived = ArchivedChangeset.objects.filter(content_type=content_type, object_pk=object_pk)
+    return sorted(list(live) + list(archived), key=lambda cs: (cs.date_created, cs.revision))
+
+
+def get_object_dependencies(obj):
+    dependencies = set()
+    for f in obj._meta.fields:
+        if not getattr(f, 'rel', None):
+            continue
+
+        pk = getattr(obj, f.attname, None)
+        if not isinstance(pk, (int, long)) or pk <= 0:
+            continue
+
+        ct = ContentType.objects.get_for_model(f.rel.to)
+        dependencies.add((ct.pk, pk))
+    return dependencies
+
+
+OVERLAY_CHUNK_SIZE = 100
+
+
+def decode_stored_diff(raw_pickle, raw_json):
+    if raw_json is not None:
+        return decode_diff(raw_json)
+    if raw_pickle is None:
+        return {}
+    return Changeset._meta.get_field('object_diff').to_python(raw_pickle) or {}
+
+
+def apply_diff_to_instance(obj, diff):
+    """
+    Sets the pending values on obj in memory only. Many-to-many values are not assigned,
+    their descriptors write to the database; their pks are kept in obj.pending_m2m.
+    """
+    obj.pending_m2m = {}
+    for k, v in diff.items():
+        try:
+            field = obj._meta.get_field(k, many_to_many=False)
+        except FieldDoesNotExist:
+            if k in [f.name for f in obj._meta.many_to_many]:
+                obj.pending_m2m[k] = [getattr(o, 'pk', o) for o in (v or [])]
+            continue
+        if not field.editable:
+            continue
+        if getattr(field, 'rel', None):
+            setattr(obj, field.attname, getattr(v, 'pk', v))
+            if hasattr(obj, field.get_cache_name()):
+                delattr(obj, field.get_cache_name())
+        else:
+            setattr(obj, field.name, v)
+
+
+def get_overlay_cache(request):
+    if not hasattr(request, '_moderation_overlay_cache'):
+        request._moderation_overlay_cache = {}
+    return request._moderation_overlay_cache
+
+
+def overlay_pending(objects, user=None, cache=None):
+    """
+    Applies the pending changes of every object in memory, folding its pending diffs
+    in order. Diffs are fetched undecoded in one query per call and only decoded for
+    objects that have pending changes; decoded diffs are kept in cache, e.g. the dict
+    returned by get_overlay_cache(request). Overlaid instances are for display only,
+    saving them would bypass moderation.
+    """
+    if not objects:
+        return objects
+    cache = cache if cache is not None else {}
+    ct = ContentType.objects.get_for_model(objects[0])
+    user_id = user and user.pk
+
+    missing = [obj.pk for obj in objects if (ct.pk, obj.pk, user_id) not in cache]
+    if missing:
+        changesets = Changeset.objects.filter(content_type=ct, object_pk__in=missing,
+            moderation_status__in=MODERATION_PENDING_LIST)
+        if user is not None:
+            changesets = changesets.filter(changed_by=user)
+        raw_diffs = {}
+        for object_pk, raw_pickle, raw_json in changesets.order_by('id').values_list('object_pk', 'object_diff', 'object_diff_json'):
+            raw_diffs.setdefault(object_pk, []).append((raw_pickle, raw_json))
+
+        for pk in missing:
+            diff = {}
+            for raw_pickle, raw_json in raw_diffs.get(pk, []):
+                diff.update(decode_stored_diff(raw_pickle, raw_json))
+            cache[(ct.pk, pk, user_id)] = diff
+
+    for obj in objects:
+        diff = cache[(ct.pk, obj.pk, user_id)]
+        obj.has_pending_changes = bool(diff)
+        apply_diff_to_instance(obj, diff)
+    return objects
+
+
+class ModeratedQuerySet(QuerySet):
+    overlay = None
+
+    def with_pending(self, user=None, cache=None):
+        return self._clone(overlay={'user': user, 'cache': cache if cache is not None else {}})
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('overlay', self.overlay)
+        return super(ModeratedQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        if self.overlay is None:
+            for obj in super(ModeratedQuerySet, self).iterator():
+                yield obj
+            return
+
+        chunk = []
+        for obj in super(ModeratedQuerySet, self).iterator():
+            chunk.append(obj)
+            if len(chunk) == OVERLAY_CHUNK_SIZE:
+                for overlaid in overlay_pending(chunk, **self.overlay):
+                    yield overlaid
+                chunk = []
+        for overlaid in overlay_pending(chunk, **self.overlay):
+            yield overlaid
+
+
+class ModeratedQuerySetManager(models.Manager):
+    def get_query_set(self):
+        return ModeratedQuerySet(self.model, using=self._db)
+
+    def with_pending(self, user=None, cache=None):
+        return self.get_query_set().with_pending(user=user, cache=cache)
+
+
+class ModeratedManager(ModeratedQuerySetManager):
     def get_query_set(self):
         return super(ModeratedManager, self).get_query_set().filter(moderation_active=True)
 
@@ -150,7 +789,20 @@ class ModeratedModel(models.Model):
     moderation_active = models.BooleanField(editable=False, default=False)
 
     objects = ModeratedManager()
-    all_objects = models.Manager()
+    all_objects = ModeratedQuerySetManager()
 
     class Meta:
-        abstract = True
\ No newline at end of file
+        abstract = True
+
+
+def invalidate_moderated_object(sender, instance, **kwargs):
+    """
+    Any save of a moderated object, also outside moderation (admin saves skipping it,
+    scripts), changes the "current" side of its cached diffs.
+    """
+    if isinstance(instance, ModeratedModel) and instance.pk is not None:
+        invalidate_object(ContentType.objects.get_for_model(instance).pk, instance.pk)
+
+post_save.connect(invalidate_moderated_object, dispatch_uid='moderation_invalidate_on_save')
+post_delete.connect(invalidate_moderated_object, dispatch_uid='moderation_invalidate_on_delete')
+m2m_changed.connect(invalidate_moderated_object, dispatch_uid='moderation_invalidate_on_m2m')
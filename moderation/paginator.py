@@ -0,0 +1,28 @@
+from django.core.paginator import Paginator, Page
+
+
+class KeysetPaginator(Paginator):
+    """
+    Paginator for querysets ordered by ascending pk. page_after seeks past the last pk of
+    the previous page, so following "next" costs the same at any depth. Numbered pages
+    still find their first pk with an OFFSET over the pk column alone, which grows with
+    the page number. The total may be given as an estimate so that no COUNT(*) is run.
+    """
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(KeysetPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._count = count
+
+    def page_after(self, pk, number=1):
+        return Page(list(self.object_list.filter(pk__gt=pk)[:self.per_page]), number, self)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        offset = (number - 1) * self.per_page
+        if not offset:
+            return Page(list(self.object_list[:self.per_page]), number, self)
+
+        boundary = list(self.object_list.values_list('pk', flat=True)[offset - 1:offset])
+        if not boundary:
+            return Page([], number, self)
+        return self.page_after(boundary[0], number)
@@ -0,0 +1,92 @@
+from django.db import transaction
+
+from moderation.bulk import mark_decided
+from moderation.cache import render_changeset_diff
+from moderation.models import Changeset, MODERATION_PENDING_LIST, MODERATION_STATUS_APPROVED, MODERATION_STATUS_REJECTED
+
+
+class SquashedChangeset(object):
+    """
+    Pending changesets of one object folded, in date_created order, into a single
+    effective diff that is rendered and applied once.
+    """
+
+    def __init__(self, changesets):
+        self.changesets = list(changesets)
+        self.effective = fold(self.changesets)
+
+    def __len__(self):
+        return len(self.changesets)
+
+    @property
+    def diff(self):
+        return self.effective.diff
+
+    def get_rendered_diff(self):
+        name = 'squash-%s' % '-'.join(str(cs.pk) for cs in self.changesets)
+        return render_changeset_diff(self.effective, name=name)
+
+    def lock_pending(self):
+        """
+        Locks and returns those of the changesets still pending. Any decided, or queued
+        for the worker, since the squash was built are left out.
+        """
+        return list(Changeset.objects.select_for_update().filter(pk__in=[cs.pk for cs in self.changesets],
+            moderation_status__in=MODERATION_PENDING_LIST).order_by('date_created', 'id'))
+
+    @transaction.commit_on_success
+    def approve(self, user, reason):
+        """
+        Applies the still pending changesets folded together; returns how many were approved.
+        """
+        pending = self.lock_pending()
+        if pending:
+            effective = fold(pending, self.effective.content_object)
+            effective.apply_changes(effective.content_object)
+            mark_decided(pending, MODERATION_STATUS_APPROVED, user, reason)
+        return len(pending)
+
+    @transaction.commit_on_success
+    def reject(self, user, reason):
+        pending = self.lock_pending()
+        mark_decided(pending, MODERATION_STATUS_REJECTED, user, reason)
+        return len(pending)
+
+
+def fold(changesets, content_object=None):
+    """
+    An unsaved changeset carrying the diffs of changesets, later ones overriding earlier.
+    """
+    first, last = changesets[0], changesets[-1]
+
+    diff = {}
+    for cs in changesets:
+        diff.update(cs.diff)
+
+    effective = Changeset(
+        content_type_id=last.content_type_id,
+        object_pk=last.object_pk,
+        moderation_status=first.moderation_status,
+        changed_by_id=last.changed_by_id,
+    )
+    effective.diff = diff
+    effective._content_object_cache = content_object or last.content_object
+    return effective
+
+
+def squash_pending(content_type, object_pk):
+    changesets = Changeset.objects.filter(content_type=content_type, object_pk=object_pk,
+        moderation_status__in=MODERATION_PENDING_LIST).order_by('date_created', 'id')
+    changesets = list(changesets)
+    if not changesets:
+        return None
+    return SquashedChangeset(changesets)
+
+
+def squash_queryset(changesets):
+    """
+    One SquashedChangeset per object touched by the given changesets, covering all
+    pending changesets of that object.
+    """
+    objects = set(changesets.exclude(object_pk=None).values_list('content_type', 'object_pk'))
+    return filter(None, [squash_pending(ct_id, object_pk) for ct_id, object_pk in sorted(objects)])
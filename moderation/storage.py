@@ -0,0 +1,44 @@
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models
+from django.db.models.query import QuerySet
+from django.utils import simplejson
+
+DIFF_STORAGE_PICKLE = 'pickle'
+DIFF_STORAGE_JSON = 'json'
+
+
+def get_diff_storage():
+    return getattr(settings, 'MODERATION_DIFF_STORAGE', DIFF_STORAGE_PICKLE)
+
+
+def field_index_enabled():
+    return getattr(settings, 'MODERATION_DIFF_FIELD_INDEX', False)
+
+
+class DiffEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, QuerySet):
+            return list(o.values_list('pk', flat=True))
+        if isinstance(o, models.Model):
+            return o.pk
+        if isinstance(o, File):
+            return o.name
+        if isinstance(o, (set, frozenset, tuple)):
+            return list(o)
+        return super(DiffEncoder, self).default(o)
+
+
+def encode_diff(diff):
+    return simplejson.dumps(diff, cls=DiffEncoder, sort_keys=True)
+
+
+def decode_diff(data):
+    return simplejson.loads(data)
+
+
+def hash_value(value):
+    return hashlib.sha1(simplejson.dumps(value, cls=DiffEncoder, sort_keys=True)).hexdigest()
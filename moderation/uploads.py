@@ -0,0 +1,63 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import models
+from django.utils.text import get_valid_filename
+
+
+def get_staging_dir():
+    return getattr(settings, 'MODERATION_STAGING_DIR', 'moderation_staging/')
+
+
+def is_staged(name):
+    return isinstance(name, basestring) and name.startswith(get_staging_dir())
+
+
+def content_hash(content):
+    sha = hashlib.sha1()
+    for chunk in content.chunks():
+        sha.update(chunk)
+    content.seek(0)
+    return sha.hexdigest()
+
+
+def stage_file(field, content):
+    """
+    Stores an upload of a pending change under its content hash and returns the staged
+    name. An identical file staged earlier is reused instead of being stored again.
+    """
+    name = '%s%s/%s' % (get_staging_dir(), content_hash(content),
+                        get_valid_filename(os.path.basename(content.name)))
+    if field.storage.exists(name):
+        return name
+    return field.storage.save(name, content)
+
+
+def promote_file(field, instance, name):
+    """
+    Copies a staged file to the path the field would have given it and returns that name.
+    The staged copy is left for the sweep_staged_uploads command, another pending change
+    may share it.
+    """
+    staged = field.storage.open(name)
+    try:
+        return field.storage.save(field.generate_filename(instance, os.path.basename(name)), staged)
+    finally:
+        staged.close()
+
+
+def staged_names(diff):
+    return set(v for v in diff.values() if is_staged(v))
+
+
+def get_staging_storages():
+    """
+    The storages of every file field of the installed models, one per storage instance.
+    """
+    storages = {}
+    for model in models.get_models():
+        for field in model._meta.fields:
+            if isinstance(field, models.FileField):
+                storages[id(field.storage)] = field.storage
+    return storages.values()